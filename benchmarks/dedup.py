@@ -0,0 +1,83 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2017 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import random
+import sys
+import timeit
+
+from kg_search.api import Entities
+
+__author__ = 'Fernando Serena'
+
+TYPES = ['Place', 'City', 'Person', 'Organization', 'SportsTeam', 'Event', 'CreativeWork', 'Thing']
+
+
+def quadratic_add_entity(entities, seed_tuple):
+    """
+    The list scan api.search used to deduplicate with, kept as the reference.
+    """
+    types, q, db, wiki, name, score = seed_tuple
+    s_dict = {'wikidata': q, 'name': name, 'dbpedia': db, 'wikipedia': wiki, 'score': score}
+    for t in types:
+        if t not in entities:
+            entities[t] = []
+        if not any(filter(
+                lambda x: x['wikipedia'].split('/')[-1] == s_dict['wikipedia'].split('/')[-1] or (
+                                x['wikidata'] is not None and x['wikidata'] == s_dict['wikidata']),
+                entities[t])):
+            entities[t].append(s_dict)
+
+
+def candidates(n, seed=0):
+    rnd = random.Random(seed)
+    tuples = []
+    for _ in range(n):
+        i = rnd.randint(0, n // 2)
+        q = 'Q{}'.format(i) if rnd.random() < 0.8 else None
+        wiki = u'https://{}.wikipedia.org/wiki/Entity_{}'.format(rnd.choice(['en', 'es']), i)
+        types = rnd.sample(TYPES, rnd.randint(1, 3))
+        tuples.append((types, q, u'http://dbpedia.org/resource/Entity_{}'.format(i), wiki, u'Entity {}'.format(i),
+                       rnd.random()))
+    return tuples
+
+
+def quadratic(tuples):
+    entities = {}
+    for seed_tuple in tuples:
+        quadratic_add_entity(entities, seed_tuple)
+    return entities
+
+
+def indexed(tuples):
+    entities = Entities()
+    for seed_tuple in tuples:
+        entities.add(seed_tuple)
+    return entities
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tuples = candidates(n)
+    same = quadratic(tuples) == indexed(tuples)
+    before = min(timeit.repeat(lambda: quadratic(tuples), number=1, repeat=3))
+    after = min(timeit.repeat(lambda: indexed(tuples), number=1, repeat=3))
+    print '{} candidates: list scan {:.1f} ms, indexed {:.1f} ms ({:.0f}x), same entities: {}'.format(
+        n, before * 1000, after * 1000, before / after, same)
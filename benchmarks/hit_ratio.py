@@ -0,0 +1,156 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2017 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import argparse
+import random
+import re
+import sys
+import unicodedata
+from collections import OrderedDict
+
+from rdflib import URIRef
+from werkzeug.datastructures import MultiDict
+from werkzeug.urls import url_decode
+
+from kg_search import search
+from kg_search.api import request_key
+
+__author__ = 'Fernando Serena'
+
+ACCESS = re.compile(r'"GET (?P<path>/search)\?(?P<query>[^ "]*) HTTP/[0-9.]+"')
+TOPICS = [u'Madrid', u'Barcelona', u'Sevilla', u'M\xe1laga', u'C\xe1diz', u'A Coru\xf1a', u'Lisbon', u'Paris',
+          u'Real Madrid', u'Atl\xe9tico de Madrid', u'Picasso', u'Cervantes', u'Gaud\xed', u'Prado Museum', u'Guernica',
+          u'Don Quixote', u'Vel\xe1zquez', u'Almod\xf3var', u'Nadal', u'Flamenco']
+TYPES = ['Place', 'City', 'Person', 'Organization', 'SportsTeam', 'CreativeWork']
+FOO = u'https://en.wikipedia.org/wiki/Foo_(bar)'
+# Memoized upstream calls, each with (args, kwargs) of calls that must share their cache entry
+EQUIVALENT_CALLS = [
+    (search.search_wiki_entity, [((FOO,), {}), ((u'https://en.wikipedia.org/wiki/Foo_%28bar%29',), {}),
+                                 ((), {'wiki': u' https://EN.wikipedia.org/wiki/Foo_(bar)#History'})]),
+    (search._nex_annotations, [((u'Madrid  is the capital',), {}), ((), {'text': u' Madrid is the capital '})]),
+    (search.enrich_wiki_entry, [((FOO, u'Foo', ['Place', 'City']), {}),
+                                ((), {'wiki': FOO, 'name': u'Foo', 'types': ['City', 'Place', 'City']})]),
+    (search._kg_request, [((u'Madrid',), {'types': ['Place', 'City']}), ((u' madrid', ['City', 'Place']), {})]),
+    (search.search_types, [((u'Madrid',), {}), ((), {'search': u'madrid '})]),
+    (search.web_entities, [((URIRef(u'HTTP://Example.org/madrid.png#top'),), {}),
+                           ((), {'img': URIRef(u'http://example.org/madrid.png')})]),
+]
+
+
+def raw_key(path, args):
+    """
+    The API cache key before canonicalization: the first value of every argument, as given.
+    It could not be made for non-ASCII arguments, so those requests were never cached (None).
+    """
+    qargs = dict(args.items())
+    try:
+        return (path + ''.join(['{}{}'.format(k, qargs[k]) for k in sorted(qargs.keys())])).encode('utf-8')
+    except UnicodeError:
+        return None
+
+
+def memo_keys():
+    """
+    Checks that equivalent calls to memoized upstream functions share their cache key, and
+    returns how many functions do not.
+    """
+    split = 0
+    for f, calls in EQUIVALENT_CALLS:
+        keys = set(f.make_cache_key(f.uncached, *args, **kwargs) for args, kwargs in calls)
+        print '{:<20} {} calls  {} keys'.format(f.__name__, len(calls), len(keys))
+        split += len(keys) > 1
+    return split
+
+
+def synthetic(n, seed=0):
+    """
+    n requests over Zipf-popular topics, spelled the ways clients happen to send them: extra
+    whitespace, decomposed accents, types in any order or repeated, flags with or without values.
+    """
+    rnd = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(len(TOPICS))]
+    for _ in range(n):
+        topic = rnd.choice([t for t, w in zip(TOPICS, weights) for _ in range(int(w * 20))])
+        args = MultiDict()
+        if rnd.random() < 0.2:
+            args['url'] = u'{}://{}/wiki/{}'.format(rnd.choice(['http', 'HTTP']),
+                                                   rnd.choice(['example.org', 'Example.org']), topic.replace(' ', '_'))
+        else:
+            q = unicodedata.normalize(rnd.choice(['NFC', 'NFD']), topic)
+            args['q'] = rnd.choice([q, q + u' ', u' ' + q.replace(u' ', u'  ')])
+        if rnd.random() < 0.5:
+            types = rnd.sample(TYPES[:3], rnd.randint(1, 3))
+            for t in types + types[:rnd.randint(0, 1)]:
+                args.add('types', t)
+        if rnd.random() < 0.3:
+            args['best'] = rnd.choice(['', '1', 'true'])
+        args['limit'] = '5'
+        yield '/search', args
+
+
+def replay(lines):
+    for line in lines:
+        match = ACCESS.search(line)
+        if match:
+            yield match.group('path'), url_decode(match.group('query'), charset='utf-8')
+
+
+class LRU(object):
+    def __init__(self, size=None):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.lookups = 0
+
+    def lookup(self, key):
+        self.lookups += 1
+        if key is None:
+            return
+        if key in self.entries:
+            self.hits += 1
+            self.entries[key] = self.entries.pop(key)
+            return
+        self.entries[key] = True
+        if self.size and len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def report(self, label):
+        print '{:<10} {:>6} lookups  {:>6} keys  hit ratio {:.1%}'.format(label, self.lookups, len(self.entries),
+                                                                          self.hits / float(self.lookups or 1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='API cache hit ratio of an access log, before and after '
+                                                 'canonicalizing cache keys.')
+    parser.add_argument('log', nargs='?', help='access log (gunicorn format); a synthetic one if not given')
+    parser.add_argument('--requests', type=int, default=10000, help='requests of the synthetic log')
+    parser.add_argument('--size', type=int, default=None, help='LRU size of the simulated cache')
+    args = parser.parse_args()
+
+    if memo_keys():
+        sys.exit('equivalent calls to memoized functions have different keys')
+
+    requests = replay(open(args.log)) if args.log else synthetic(args.requests)
+    raw, canonical = LRU(args.size), LRU(args.size)
+    for path, qargs in requests:
+        raw.lookup(raw_key(path, qargs))
+        canonical.lookup(request_key(path, qargs))
+    raw.report('raw')
+    canonical.report('canonical')
@@ -0,0 +1,51 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2017 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import glob
+import json
+import os
+import sys
+import timeit
+
+from rdflib.compare import isomorphic
+
+from kg_search.ld import ld_triples
+
+__author__ = 'Fernando Serena'
+
+# Recorded KG payloads, the only JSON-LD ones
+PAYLOADS = os.path.join(os.path.dirname(__file__), 'payloads', 'kg_*.json')
+
+
+def bench(ld, normalize, number):
+    return min(timeit.repeat(lambda: ld_triples(ld, normalize=normalize), number=number, repeat=3)) / number
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for path in sorted(glob.glob(PAYLOADS)):
+        with open(path) as f:
+            ld = json.load(f)
+        same = isomorphic(ld_triples(ld, normalize=True), ld_triples(ld))
+        normalized = bench(ld, True, number)
+        streamed = bench(ld, False, number)
+        print '{}: normalize {:.2f} ms, streaming {:.2f} ms ({:.1f}x), isomorphic: {}'.format(
+            os.path.basename(path), normalized * 1000, streamed * 1000, normalized / streamed, same)
@@ -0,0 +1,172 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2017 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from stubs import StubServer, parse_rates
+
+__author__ = 'Fernando Serena'
+
+LAUNCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'kg-search')
+TOPICS = [u'madrid', u'barcelona', u'sevilla', u'valencia', u'lisbon', u'paris', u'berlin', u'rome', u'london',
+          u'real madrid', u'atletico', u'picasso', u'cervantes', u'gaudi', u'prado museum', u'flamenco',
+          u'alhambra', u'tapas', u'la liga', u'nadal', u'almodovar', u'guernica', u'don quixote', u'velazquez']
+DEFAULT_LATENCY = 'kg=0.08,vision=0.3,nex=0.12,wikipedia=0.1,wikidata=0.15,dbpedia=0.2'
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def workload(kind, n, seed=0):
+    """
+    n distinct requests of a kind as (method, params, files) tuples.
+    """
+    rnd = random.Random(seed)
+    requests_ = []
+    for i in range(n):
+        topic = TOPICS[i % len(TOPICS)]
+        if i >= len(TOPICS):
+            topic = u'{} {}'.format(topic, i // len(TOPICS))
+        if kind == 'text':
+            requests_.append(('GET', {'q': topic, 'limit': 5}, None))
+        elif kind == 'url':
+            requests_.append(('GET', {'url': u'https://example.org/news/{}'.format(topic.replace(' ', '-'))}, None))
+        else:
+            content = ''.join(chr(rnd.randint(0, 255)) for _ in range(2048))
+            requests_.append(('POST', {'limit': 5}, {'file': ('{}.png'.format(i), content)}))
+    return requests_
+
+
+class Service(object):
+    """
+    kg-search launched on a free port with a fresh cache, pointed at the stubs.
+    """
+
+    def __init__(self, stubs):
+        self.port = free_port()
+        self.root = tempfile.mkdtemp(prefix='kg-search-bench-')
+        env = dict(os.environ)
+        env.update(stubs.environ())
+        env.update({'API_PORT': str(self.port), 'CACHE_ROOT': self.root, 'GOOGLE_API_KEY': 'bench',
+                    'DANDELION_API_KEY': 'bench', 'WIKIDATA_CLASSES': os.path.join(self.root, 'classes.json'),
+                    'LOG_LEVEL': env.get('LOG_LEVEL', 'WARNING')})
+        self.process = subprocess.Popen([sys.executable, LAUNCHER], env=env, cwd=self.root)
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+        deadline = time.time() + 60
+        while True:
+            try:
+                requests.get(self.url + '/metrics', timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError('kg-search did not start')
+                time.sleep(0.2)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def drive(service, requests_, concurrency):
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def call(request):
+        method, params, files = request
+        start = time.time()
+        response = session.request(method, service.url + '/search', params=params, files=files, timeout=300)
+        elapsed = time.time() - start
+        found = sum(len(records) for records in response.json().values()) if response.status_code == 200 else 0
+        return elapsed, response.status_code, found
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, requests_))
+    return time.time() - start, results
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)]
+
+
+def report(label, elapsed, results, calls, failures):
+    latencies = [latency for latency, _, _ in results]
+    errors = sum(1 for _, status, _ in results if status != 200)
+    found = sum(n for _, _, n in results)
+    upstream = ' '.join('{}={}/{}'.format(provider, n, failures.get(provider, 0))
+                        for provider, n in sorted(calls.items()) if n)
+    print '{:<24} {:>7.1f} req/s  p50 {:>7.1f} ms  p99 {:>7.1f} ms  errors {:>3}  entities {:>4}  ' \
+          'upstream calls/failures: {}'.format(label, len(results) / elapsed, percentile(latencies, 50) * 1000,
+                                               percentile(latencies, 99) * 1000, errors, found, upstream or '-')
+
+
+def upstream_calls(stubs, before):
+    """
+    Calls and failed calls per provider since the before stats.
+    """
+    return [{provider: n - counts.get(provider, 0) for provider, n in now.items()}
+            for now, counts in zip(stubs.stats(), before)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drives kg-search /search against local upstream stubs.')
+    parser.add_argument('--workloads', default='text,url,image')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--requests', type=int, default=48, help='distinct requests per run')
+    parser.add_argument('--latency', default=DEFAULT_LATENCY, help='seconds per provider, e.g. kg=0.08')
+    parser.add_argument('--errors', default='', help='error rate per provider, e.g. wikidata=0.05')
+    parser.add_argument('--capacity', default='', help='requests in flight per provider before 429s, e.g. wikidata=5')
+    args = parser.parse_args()
+
+    stubs = StubServer(latency=parse_rates(args.latency), errors=parse_rates(args.errors),
+                       capacity=parse_rates(args.capacity)).start()
+    for kind in args.workloads.split(','):
+        requests_ = workload(kind, args.requests)
+        for concurrency in map(int, args.concurrency.split(',')):
+            service = Service(stubs)
+            try:
+                for scenario in ('cold', 'warm'):
+                    before = stubs.stats()
+                    elapsed, results = drive(service, requests_, concurrency)
+                    report('{} c={} {}'.format(kind, concurrency, scenario), elapsed, results,
+                           *upstream_calls(stubs, before))
+            finally:
+                service.stop()
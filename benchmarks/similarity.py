@@ -0,0 +1,97 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2017 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import json
+import os
+import random
+import sys
+import timeit
+
+from kg_search import similarity
+from kg_search.similarity import Query, similar
+
+__author__ = 'Fernando Serena'
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpora', 'names.json')
+
+
+def perturb(rnd, name):
+    chars = list(name)
+    for _ in range(rnd.randint(0, max(1, len(chars) // 2))):
+        op = rnd.random()
+        i = rnd.randint(0, len(chars))
+        if op < 0.4 and chars:
+            del chars[min(i, len(chars) - 1)]
+        elif op < 0.8:
+            chars.insert(i, rnd.choice(u'abcdefghijklmnopqrstuvwxyz .'))
+        else:
+            chars = chars[i:] + [u' '] + chars[:i]
+    return u''.join(chars)
+
+
+def pairs(n, seed=0):
+    """
+    Two sets of (query, name) pairs: every query of the corpus against every name in it, and
+    n random edits of names against their own query.
+    """
+    with open(CORPUS) as f:
+        corpus = json.load(f)
+    rnd = random.Random(seed)
+    queries = [q for q, _ in corpus]
+    names = [name for _, q_names in corpus for name in q_names]
+    edits = []
+    for _ in range(n):
+        query, query_names = rnd.choice(corpus)
+        edits.append((query, perturb(rnd, rnd.choice(query_names + [query]))))
+    return [('corpus', [(q, name) for q in queries for name in names]), ('edits', edits)]
+
+
+def gate_sequence_matcher(pairs):
+    return [similar(query, name) > 0.5 for query, name in pairs]
+
+
+def gate_query(pairs):
+    similarity._memo.clear()
+    queries = {}
+    decisions = []
+    for query, name in pairs:
+        if query not in queries:
+            queries[query] = Query(query)
+        decisions.append(queries[query].matches(name))
+    return decisions
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    failed = False
+    for label, corpus in pairs(n):
+        expected = gate_sequence_matcher(corpus)
+        decisions = gate_query(corpus)
+        disagree = [pair for pair, a, b in zip(corpus, expected, decisions) if a != b]
+        before = min(timeit.repeat(lambda: gate_sequence_matcher(corpus), number=1, repeat=3))
+        after = min(timeit.repeat(lambda: gate_query(corpus), number=1, repeat=3))
+        print u'{}: {} pairs ({} similar), SequenceMatcher {:.1f} ms, Query {:.1f} ms ({:.1f}x), ' \
+              u'disagreements: {}'.format(label, len(corpus), sum(expected), before * 1000, after * 1000,
+                                          before / after, len(disagree))
+        for query, name in disagree:
+            print u'  {!r} {!r}'.format(query, name)
+        failed = failed or bool(disagree)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,253 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2017 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import json
+import os
+import random
+import re
+import time
+import urlparse
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Lock, Thread
+
+__author__ = 'Fernando Serena'
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), 'payloads')
+PROVIDERS = ('kg', 'vision', 'nex', 'wikipedia', 'wikidata', 'dbpedia')
+
+# Stand-in class hierarchy: Wikidata class -> schema.org types of its P279*/P1709 closure
+CLASSES = {'Q515': ['City', 'Place'], 'Q6256': ['Country', 'Place'], 'Q5': ['Person'],
+           'Q43229': ['Organization'], 'Q476028': ['SportsTeam', 'Organization'], 'Q571': ['Book', 'CreativeWork'],
+           'Q11424': ['Movie', 'CreativeWork'], 'Q1656682': ['Event']}
+KG_TYPES = [['City', 'Place', 'Thing'], ['Person', 'Thing'], ['Organization', 'Thing'],
+            ['SportsTeam', 'Organization', 'Thing'], ['Movie', 'CreativeWork', 'Thing'], ['Thing']]
+
+
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return zlib.crc32(value) & 0xffffffff
+
+
+def _title(value):
+    return value.strip().replace(' ', '_').capitalize()
+
+
+def _item(article):
+    return 'Q{}'.format(_hash(article) % 10000000 + 100)
+
+
+def recorded(provider, key):
+    """
+    Recorded response of a provider for a key (e.g. a KG query), stored as payloads/<provider>_<key>.json.
+    """
+    path = os.path.join(PAYLOADS, '{}_{}.json'.format(provider, re.sub(r'\W+', '_', key.lower()).strip('_')))
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+
+
+def kg(params):
+    q = params.get('query', '')
+    data = recorded('kg', q)
+    if data is not None:
+        return data
+    limit = int(params.get('limit', 10))
+    elements = []
+    for i in range(min(limit, 5)):
+        name = q.title() if not i else u'{} {}'.format(q.title(), i)
+        elements.append({'@type': 'EntitySearchResult', 'resultScore': 1000.0 / (i + 1), 'result': {
+            '@id': 'kg:/m/{:x}'.format(_hash(name)), 'name': name, '@type': KG_TYPES[_hash(name) % len(KG_TYPES)],
+            'detailedDescription': {'url': u'https://en.wikipedia.org/wiki/{}'.format(_title(name))}}})
+    return {'@type': 'ItemList', 'itemListElement': elements}
+
+
+def nex(params):
+    text = params.get('text') or params.get('url', '')
+    data = recorded('nex', text)
+    if data is not None:
+        return data
+    words = [w for w in re.findall(r'\w+', text, re.UNICODE) if len(w) > 3][:5]
+    return {'annotations': [{'uri': u'https://en.wikipedia.org/wiki/{}'.format(_title(w)), 'title': w.title(),
+                             'confidence': 0.55 + (_hash(w) % 40) / 100.0} for w in words]}
+
+
+def wikipedia(params):
+    if params.get('list') == 'search':
+        query = params.get('srsearch', '')
+        return {'query': {'search': [{'title': query.title()}]}}
+    title = params.get('titles', '')
+    return {'query': {'pages': {str(_hash(title) % 1000000): {
+        'title': title, 'fullurl': u'https://en.wikipedia.org/wiki/{}'.format(_title(title))}}}}
+
+
+def vision(body):
+    image = json.loads(body)['requests'][0]['image']
+    seed = image.get('source', {}).get('imageUri') or image.get('content', '')
+    words = ['madrid', 'barcelona', 'cathedral', 'football', 'museum', 'river', 'bridge', 'festival']
+    rnd = random.Random(_hash(seed))
+    return {'responses': [{'webDetection': {'webEntities': [
+        {'description': word, 'score': rnd.random()} for word in rnd.sample(words, 4)]}}]}
+
+
+def _bindings(rows):
+    return {'head': {}, 'results': {'bindings': [
+        {var: {'type': 'uri', 'value': value} for var, value in row.items()} for row in rows]}}
+
+
+def wikidata(params):
+    query = params.get('query', '')
+    entity = 'http://www.wikidata.org/entity/'
+    if 'schema:about' in query:
+        return _bindings({'article': article, 'item': entity + _item(article)}
+                         for article in re.findall(r'<(https?://[^>]+)>', query) if 'wikipedia.org' in article)
+    if 'wdt:P31 ?class' in query:
+        classes = sorted(CLASSES)
+        return _bindings({'item': entity + item, 'class': entity + classes[_hash(item) % len(classes)]}
+                         for item in re.findall(r'wd:(Q\d+)', query))
+    return _bindings({'class': entity + cls, 'wd': 'http://schema.org/' + ty}
+                     for cls in re.findall(r'wd:(Q\d+)', query) for ty in CLASSES.get(cls, []))
+
+
+def dbpedia(params):
+    query = params.get('query', '')
+    types = ['Place', 'City', 'Person', 'Organization', 'CreativeWork']
+    rows = []
+    for uri in re.findall(r'<(http://dbpedia.org/resource/[^>]+)>', query):
+        ty = 'http://schema.org/' + types[_hash(uri) % len(types)]
+        rows.append({'s': uri, 'type': ty} if 'VALUES' in query else {'type': ty})
+    return _bindings(rows)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for every upstream service, under /<provider>/..., with per-provider latency
+    (seconds, jittered by +-20%), error rate (HTTP 503) and capacity: requests beyond that many
+    in flight are throttled (HTTP 429 with Retry-After). GET /_stats returns call counts.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port=0, latency=None, errors=None, capacity=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.latency = latency or {}
+        self.errors = errors or {}
+        self.capacity = capacity or {}
+        self.active = {}
+        self.calls = {}
+        self.failures = {}
+        self.lock = Lock()
+        self.rnd = random.Random(0)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def environ(self):
+        """
+        Environment that points kg-search at the stubs.
+        """
+        return {'KG_SEARCH_API': self.url + '/kg/v1/entities:search', 'VISION_API': self.url + '/vision/v1/images:annotate',
+                'DANDELION_NEX_API': self.url + '/nex/datatxt/nex/v1', 'WIKIPEDIA_API': self.url + '/wikipedia/w/api.php',
+                'WIKIDATA_SPARQL': self.url + '/wikidata/sparql', 'DBPEDIA_SPARQL': self.url + '/dbpedia/sparql'}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls), dict(self.failures)
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, data, headers=()):
+        body = json.dumps(data)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, body=None):
+        server = self.server
+        parts = urlparse.urlsplit(self.path)
+        provider = parts.path.strip('/').split('/')[0]
+        if provider == '_stats':
+            calls, failures = server.stats()
+            return self._respond(200, {'calls': calls, 'failures': failures})
+        if provider not in PROVIDERS:
+            return self._respond(404, {})
+
+        params = {k: v.decode('utf-8') for k, v in urlparse.parse_qsl(parts.query, keep_blank_values=True)}
+        if body and provider != 'vision':
+            params.update({k: v.decode('utf-8') for k, v in urlparse.parse_qsl(body, keep_blank_values=True)})
+        with server.lock:
+            server.calls[provider] = server.calls.get(provider, 0) + 1
+            jitter = server.rnd.uniform(0.8, 1.2)
+            throttled = server.active.get(provider, 0) >= server.capacity.get(provider, float('inf'))
+            fail = throttled or server.rnd.random() < server.errors.get(provider, 0)
+            if fail:
+                server.failures[provider] = server.failures.get(provider, 0) + 1
+            else:
+                server.active[provider] = server.active.get(provider, 0) + 1
+        if throttled:
+            return self._respond(429, {'error': 'throttled'}, headers=[('Retry-After', '1')])
+        try:
+            time.sleep(server.latency.get(provider, 0) * jitter)
+        finally:
+            if not fail:
+                with server.lock:
+                    server.active[provider] -= 1
+        if fail:
+            return self._respond(503, {'error': 'injected'})
+
+        if provider == 'vision':
+            return self._respond(200, vision(body))
+        return self._respond(200, globals()[provider](params))
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+
+def parse_rates(spec):
+    """
+    Parses 'kg=0.1,wikidata=0.25' into {'kg': 0.1, 'wikidata': 0.25}.
+    """
+    rates = {}
+    for part in filter(None, (spec or '').split(',')):
+        provider, value = part.split('=')
+        rates[provider.strip()] = float(value)
+    return rates
@@ -21,12 +21,65 @@
 
 __author__ = 'Fernando Serena'
 
+import logging
+import os
+
+WORKERS = int(os.environ.get('WORKERS', 1))
+WORKER_CLASS = os.environ.get('WORKER_CLASS', 'gthread')
+GREEN = WORKER_CLASS == 'gevent'
+
+if GREEN:
+    # Every in-flight upstream call becomes a greenlet waiting on its socket instead of a thread.
+    # Sockets, threads and locks must be patched before anything (requests, futures) is imported.
+    from gevent import monkey
+
+    monkey.patch_all()
+
 from flask import Flask
 from flask_cache import Cache
 
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+logging.basicConfig(level=LOG_LEVEL,
+                    format='%(asctime)s %(levelname)s %(name)s pid=%(process)d thread=%(threadName)s %(message)s')
+
+# Several worker processes share one SQLite store per cache, which also coalesces their upstream calls
+CACHE_TYPE = os.environ.get('CACHE_TYPE', 'tiered' if WORKERS > 1 else 'filesystem')
+CACHE_ROOT = os.environ.get('CACHE_ROOT', '')
+CACHE_LRU_SIZE = int(os.environ.get('CACHE_LRU_SIZE', 1024))
+# Seconds an LRU entry is trusted before it is read again from the store other workers write to
+CACHE_LRU_TTL = float(os.environ.get('CACHE_LRU_TTL', 5))
+
+
+def cache_config(name, **config):
+    """
+    Config of a named cache for the configured backend: 'filesystem' (one pickle file per entry)
+    or 'tiered' (in-process LRU over a single SQLite file).
+    """
+    config['CACHE_DIR'] = os.path.join(CACHE_ROOT, name)
+    if CACHE_TYPE == 'tiered':
+        config.update({'CACHE_TYPE': 'kg_search.caching.tiered', 'CACHE_LRU_SIZE': CACHE_LRU_SIZE,
+                       'CACHE_LRU_TTL': CACHE_LRU_TTL})
+    elif CACHE_TYPE == 'filesystem':
+        config['CACHE_TYPE'] = 'kg_search.caching.filesystem'
+    else:
+        config['CACHE_TYPE'] = CACHE_TYPE
+    return config
+
+
 app = Flask(__name__)
-cache = Cache(app, config={'CACHE_TYPE': 'filesystem', 'CACHE_DIR': 'api_cache'})
-kg_cache = Cache(app, config={'CACHE_TYPE': 'filesystem', 'CACHE_DIR': 'kg_cache', 'CACHE_THRESHOLD': 10000})
-wd_cache = Cache(app, config={'CACHE_TYPE': 'filesystem', 'CACHE_DIR': 'wd_cache', 'CACHE_THRESHOLD': 100000})
-wp_cache = Cache(app, config={'CACHE_TYPE': 'filesystem', 'CACHE_DIR': 'wp_cache', 'CACHE_THRESHOLD': 1000})
-dn_cache = Cache(app, config={'CACHE_TYPE': 'filesystem', 'CACHE_DIR': 'dn_cache', 'CACHE_THRESHOLD': 10000})
+cache = Cache(app, config=cache_config('api_cache'))
+kg_cache = Cache(app, config=cache_config('kg_cache', CACHE_THRESHOLD=10000))
+wd_cache = Cache(app, config=cache_config('wd_cache', CACHE_THRESHOLD=100000))
+wp_cache = Cache(app, config=cache_config('wp_cache', CACHE_THRESHOLD=1000))
+dn_cache = Cache(app, config=cache_config('dn_cache', CACHE_THRESHOLD=10000))
+vs_cache = Cache(app, config=cache_config('vs_cache', CACHE_THRESHOLD=10000))
+
+from kg_search.caching import instrument
+
+instrument(cache, 'api_cache')
+instrument(kg_cache, 'kg_cache')
+instrument(wd_cache, 'wd_cache')
+instrument(wp_cache, 'wp_cache')
+instrument(dn_cache, 'dn_cache')
+instrument(vs_cache, 'vs_cache')
@@ -19,31 +19,229 @@
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
 
-import traceback
+import heapq
+import logging
+import os
+import urllib
+from functools import wraps
+from itertools import count
+from threading import Lock
 
-from flask import request, redirect
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+
+from flask import request, redirect, abort, g, Response, stream_with_context
+from flask import json
 from flask.json import jsonify
 from werkzeug.utils import secure_filename
 
 from rdflib import URIRef
 
-from kg_search import app, cache
-from kg_search.search import search_seeds_from_image, search_seeds_from_text, search_seeds_from_url
+from kg_search import app, cache, canonical, GREEN, metrics
+from kg_search.caching import tracking
+from kg_search.search import search_seeds_from_image, search_seeds_from_text, search_seeds_from_url, SearchBudget, \
+    CallScope, submit, ImageContent, ImageTooLarge
 
 __author__ = 'Fernando Serena'
 
+log = logging.getLogger(__name__)
+
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+STREAM_MIMETYPES = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+BATCH_JOB_ARGS = {'q', 'url', 'img', 'types', 'limit', 'best', 'timeout', 'max_calls'}
+# Canonical forms of /search arguments. Case stays in q, as entity recognition tells it apart
+CANONICAL_ARGS = {'q': canonical.text, 'url': canonical.url, 'img': canonical.url, 'raw': lambda _: u'',
+                  'best': lambda _: u''}
+
+# Uploads beyond this are refused while reading the request; large ones are spooled to disk. Flask
+# defaults it to None, which is no limit
+if app.config.get('MAX_CONTENT_LENGTH') is None:
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_SIZE', 32 * 1024 * 1024))
+
+batch_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('BATCH_SEARCH_WORKERS', 64 if GREEN else 8)))
+
+
+def request_key(path, args):
+    """
+    Key of a request in the API cache: its path and canonical arguments, types sorted and deduplicated.
+    """
+    query = []
+    for name in sorted(set(args.keys())):
+        values = args.getlist(name)
+        if name == 'types':
+            values = canonical.types(values)
+        elif name in CANONICAL_ARGS:
+            values = map(CANONICAL_ARGS[name], values)
+        query.extend((name, value.encode('utf-8')) for value in values)
+    return '{}?{}'.format(path, urllib.urlencode(query))
 
 
 def make_cache_key(*args, **kwargs):
-    path = request.path
-    qargs = dict(request.args.items())
-    args = ''.join(['{}{}'.format(k, qargs[k]) for k in sorted(qargs.keys())])
-    return (path + args).encode('utf-8')
+    return request_key(request.path, request.args)
+
+
+def cached_search(timeout):
+    """
+    Flask-Cache's cached for /search, except for POSTs, streams and the answers of searches
+    whose budget ran out or that fell back from failed calls, which may be missing entities.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method == 'POST' or 'stream' in request.args:
+                return f(*args, **kwargs)
+            key = make_cache_key()
+            rv = cache.get(key)
+            if rv is None:
+                rv = f(*args, **kwargs)
+                budget = g.get('search_budget', None)
+                if rv is not None and (budget is None or not (budget.exhausted or budget.degraded)):
+                    cache.set(key, rv, timeout=timeout)
+            return rv
+
+        decorated_function.uncached = f
+        decorated_function.cache_timeout = timeout
+        decorated_function.make_cache_key = make_cache_key
+        return decorated_function
+
+    return decorator
+
+
+class TopK(object):
+    """
+    Incrementally selects the seed tuples /search answers with: the best `limit` ones
+    scoring at least 0.1 and, in `best` mode, within 0.05 of the top score.
+    """
+
+    def __init__(self, limit=None, best=False, min_score=0.1, margin=0.05):
+        self.limit = limit
+        self.best = best
+        self.min_score = min_score
+        self.margin = margin
+        self.top = None
+        self.__heap = []
+        self.__seq = count()
+        self.__lock = Lock()
+
+    @property
+    def key(self):
+        return 'top', self.limit, self.best, self.min_score, self.margin
+
+    def admits(self, score):
+        if score < self.min_score:
+            return False
+        if self.best and self.top is not None and self.top - score > self.margin:
+            return False
+        if self.limit and len(self.__heap) >= self.limit and score < self.__heap[0][0]:
+            return False
+        return True
+
+    def push(self, seed_tuple):
+        score = seed_tuple[5]
+        with self.__lock:
+            if not self.admits(score):
+                return False
+            heapq.heappush(self.__heap, (score, next(self.__seq), seed_tuple))
+            if self.limit and len(self.__heap) > self.limit:
+                heapq.heappop(self.__heap)
+            if self.top is None or score > self.top:
+                self.top = score
+            return True
+
+    def items(self):
+        return [seed_tuple for score, _, seed_tuple in sorted(self.__heap, reverse=True) if self.admits(score)]
+
+
+class Entities(dict):
+    """
+    Entity records by type. Two entities are equal when they share their Wikipedia article
+    name or their Wikidata entity, which per-type indexes on both tell in constant time.
+    """
+
+    def __init__(self):
+        super(Entities, self).__init__()
+        self.__wikis = {}
+        self.__qs = {}
+
+    def add(self, seed_tuple):
+        """
+        Adds the record of a seed tuple to the entities of each of its types, unless an equal
+        entity is already there. Returns the (type, record) pairs that were added.
+        """
+        types, q, db, wiki, name, score = seed_tuple
+        s_dict = {'wikidata': q, 'name': name, 'dbpedia': db, 'wikipedia': wiki, 'score': score}
+        article = wiki.split('/')[-1]
+        added = []
+        for t in types:
+            wikis = self.__wikis.setdefault(t, set())
+            qs = self.__qs.setdefault(t, set())
+            if article in wikis or (q is not None and q in qs):
+                continue
+            self.setdefault(t, []).append(s_dict)
+            wikis.add(article)
+            if q is not None:
+                qs.add(q)
+            added.append((t, s_dict))
+        return added
+
 
+def stream_entities(gen, selector, fmt='ndjson'):
+    """
+    Emits every entity record as soon as its seed tuple is admitted by the selector, then a
+    summary record holding the same entities a non-streamed /search would answer with.
+    """
 
-def are_equal(a, b):
-    return a.split('/')[-1] == b.split('/')[-1]
+    def event(kind, data):
+        if fmt == 'sse':
+            return 'event: {}\ndata: {}\n\n'.format(kind, json.dumps(data))
+        return json.dumps({kind: data}) + '\n'
+
+    streamed = Entities()
+    for seed_tuple in gen:
+        if selector.push(seed_tuple):
+            for t, s_dict in streamed.add(seed_tuple):
+                yield event('entity', {'type': t, 'record': s_dict})
+
+    yield event('summary', assemble(selector.items()))
+
+
+def seeds(q=None, url=None, img=None, types=None, limit=None, raw=False, budget=None, selector=None):
+    if img:
+        return search_seeds_from_image(img, types=types, count=limit, raw=raw, budget=budget, cutoff=selector)
+    elif url:
+        return search_seeds_from_url(url, types=types, count=limit, budget=budget, cutoff=selector)
+    return search_seeds_from_text(q, types=types, count=limit, budget=budget, cutoff=selector)
+
+
+@metrics.stage('assemble')
+def assemble(seed_tuples):
+    entities = Entities()
+    for seed_tuple in seed_tuples:
+        entities.add(seed_tuple)
+    return entities
+
+
+def select_entities(gen, selector):
+    for seed_tuple in gen:
+        selector.push(seed_tuple)
+    return assemble(selector.items())
+
+
+def search_job(q=None, url=None, img=None, types=None, limit=None, best=False, timeout=None, max_calls=None):
+    """
+    Runs one job of a batch search and returns the entities /search would answer with.
+    """
+    if img:
+        img = URIRef(img)
+    if url:
+        url = URIRef(url)
+    if isinstance(types, basestring):
+        types = [types]
+    selector = TopK(limit=limit, best=best)
+    budget = SearchBudget(timeout=timeout, max_calls=max_calls)
+    with app.app_context():
+        gen = seeds(q=q, url=url, img=img, types=types or [], limit=limit, budget=budget, selector=selector)
+        return select_entities(gen, selector)
 
 
 def allowed_file(filename):
@@ -52,7 +250,7 @@ def allowed_file(filename):
 
 
 @app.route('/search', methods=['GET', 'POST'])
-@cache.cached(timeout=3600, key_prefix=make_cache_key, unless=lambda: request.method == 'POST')
+@cached_search(timeout=3600)
 def search():
     img = None
     raw = False
@@ -69,8 +267,12 @@ def search():
             # file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
             # return redirect(url_for('uploaded_file',
             #                         filename=filename))
-            img = file
+            try:
+                img = ImageContent(file.stream)
+            except ImageTooLarge:
+                abort(413)
 
+    q = url = None
     if img is None:
         img = request.args.get('img')
         if img:
@@ -94,42 +296,80 @@ def search():
         if best is not None:
             best = True
 
-        entities = {}
-        if img is not None:
-            gen = search_seeds_from_image(img, types=types, count=limit, raw=raw)
-            if raw:
+        timeout = request.args.get('timeout', None)
+        if timeout is not None:
+            timeout = float(timeout)
+        max_calls = request.args.get('max_calls', None)
+        if max_calls is not None:
+            max_calls = int(max_calls)
+        budget = g.search_budget = SearchBudget(timeout=timeout, max_calls=max_calls)
+
+        selector = TopK(limit=limit, best=best)
+        gen = seeds(q=q, url=url, img=img, types=types, limit=limit, raw=raw, budget=budget, selector=selector)
+        with tracking(budget):
+            if raw and img is not None:
                 return jsonify(list(gen))
-        elif url is not None:
-            gen = search_seeds_from_url(url, types=types, count=limit)
-        else:
-            gen = search_seeds_from_text(q, types=types, count=limit)
-
-        best_score = 0.0
-        n = 0
-        for types, q, db, wiki, name, score in sorted(list(gen), key=lambda x: x[5], reverse=True):
-            if score < 0.1:
-                continue
-            if best and (score - best_score) > 0.05:
-                entities = {}
-                best_score = score
-            if best and abs(score - best_score) > 0.05:
-                continue
-            for t in types:
-                if t not in entities:
-                    entities[t] = []
-                s_dict = {'wikidata': q, 'name': name, 'dbpedia': db, 'wikipedia': wiki, 'score': score}
-                if not any(filter(
-                        lambda x: are_equal(x['wikipedia'], s_dict['wikipedia']) or (
-                                        x['wikidata'] is not None and x['wikidata'] == s_dict['wikidata']),
-                        entities[t])):
-                    entities[t].append(s_dict)
-
-            n += 1
-            if n == limit:
-                break
-        return jsonify(entities)
+
+            stream = request.args.get('stream', None)
+            if stream in STREAM_MIMETYPES:
+                return Response(stream_with_context(stream_entities(gen, selector, fmt=stream)),
+                                mimetype=STREAM_MIMETYPES[stream])
+
+            return jsonify(select_entities(gen, selector))
     except Exception:
-        traceback.print_exc()
+        log.exception('search failed')
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """
+    Runs a list of search jobs ({q|url|img, types, limit, best, timeout, max_calls}) concurrently.
+    Identical upstream calls are made only once for the whole batch. Jobs that are no objects
+    answer with an error of their own.
+    """
+    body = request.get_json(force=True)
+    jobs = body.get('jobs', []) if isinstance(body, dict) else body
+    if not isinstance(jobs, list):
+        abort(400)
+    stream = request.args.get('stream', None)
+
+    scope = CallScope()
+    with scope:
+        futures = {}
+        for i, job in enumerate(jobs):
+            if isinstance(job, dict):
+                job = {k: v for k, v in job.items() if k in BATCH_JOB_ARGS}
+                future = submit(batch_pool, search_job, **job)
+            else:
+                future = Future()
+                future.set_exception(ValueError('job is not an object'))
+            futures[future] = i
+
+    def job_result(future):
+        try:
+            return {'job': futures[future], 'result': future.result()}
+        except Exception as e:
+            log.warning('batch search job %s failed', futures[future], exc_info=True)
+            return {'job': futures[future], 'error': str(e)}
+
+    if stream in STREAM_MIMETYPES:
+        def events():
+            for future in as_completed(futures):
+                result = job_result(future)
+                if stream == 'sse':
+                    yield 'event: job\ndata: {}\n\n'.format(json.dumps(result))
+                else:
+                    yield json.dumps(result) + '\n'
+
+        return Response(stream_with_context(events()), mimetype=STREAM_MIMETYPES[stream])
+
+    results = sorted(map(job_result, futures), key=lambda x: x['job'])
+    return jsonify(results=results)
+
+
+@app.route('/metrics')
+def metrics_exposition():
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
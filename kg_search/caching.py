@@ -0,0 +1,595 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import copy
+import hashlib
+import inspect
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from werkzeug.contrib.cache import BaseCache, FileSystemCache as _FileSystemCache
+
+from kg_search import metrics, upstream
+from kg_search.canonical import arguments as canonical_arguments
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger(__name__)
+
+EMPTY_TIMEOUT = int(os.environ.get('MEMO_EMPTY_TIMEOUT', 3600))
+FAILURE_TIMEOUT = int(os.environ.get('MEMO_FAILURE_TIMEOUT', 60))
+
+refresh_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('MEMO_REFRESH_WORKERS', 4)))
+
+# Lock entries that shared backends hold next to a key while it is fetched or refreshed
+FLIGHT, REFRESH = '.flight', '.refresh'
+
+
+class TieredCache(BaseCache):
+    """
+    In-process LRU of pickled entries in front of a single-file SQLite store.
+    Entries expire by timeout and the store is pruned back to `threshold` entries, dropping
+    expired and then least recently written ones first. The store can be shared by several
+    processes, so the LRU trusts an entry for `lru_ttl` seconds before reading it again.
+    """
+
+    # add() is atomic across processes
+    shared = True
+    hashed_keys = False
+    on_evict = None
+
+    def __init__(self, path, threshold=500, lru_size=1024, lru_ttl=5, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.path = path
+        self.threshold = threshold
+        self.lru_size = lru_size
+        self.lru_ttl = lru_ttl
+        self.__lru = OrderedDict()
+        self.__lock = Lock()
+        self.__local = local()
+        self.__writes = 0
+        self.__prune_every = max(threshold // 100, 1)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another worker meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        self._db().execute('CREATE TABLE IF NOT EXISTS entries '
+                           '(key TEXT PRIMARY KEY, value BLOB, expires REAL, stored REAL)')
+        self._db().execute('CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored)')
+
+    def _db(self):
+        # One connection per thread, and never one inherited through fork
+        if getattr(self.__local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.text_factory = str
+            self.__local.db = db
+            self.__local.pid = os.getpid()
+        return self.__local.db
+
+    def _expires(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout else 0
+
+    @staticmethod
+    def _alive(expires):
+        return not expires or expires > time.time()
+
+    def _remember(self, key, data, expires):
+        with self.__lock:
+            self.__lru.pop(key, None)
+            self.__lru[key] = (data, expires, time.time() + self.lru_ttl)
+            while len(self.__lru) > self.lru_size:
+                self.__lru.popitem(last=False)
+
+    def _forget(self, key):
+        with self.__lock:
+            self.__lru.pop(key, None)
+
+    def _prune(self):
+        self.__writes += 1
+        if self.__writes % self.__prune_every:
+            return
+        self._evict()
+
+    def _evict(self):
+        db = self._db()
+        if db.execute('SELECT COUNT(*) FROM entries').fetchone()[0] <= self.threshold:
+            return
+        evicted = db.execute('DELETE FROM entries WHERE expires > 0 AND expires <= ?', (time.time(),)).rowcount
+        excess = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.threshold
+        if excess > 0:
+            evicted += db.execute('DELETE FROM entries WHERE key IN '
+                                  '(SELECT key FROM entries ORDER BY stored LIMIT ?)', (excess,)).rowcount
+        if self.on_evict is not None:
+            self.on_evict(evicted)
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__lru.pop(key, None)
+            # Other workers may have rewritten or deleted it since
+            if entry is not None and entry[2] > time.time():
+                self.__lru[key] = entry
+                data, expires = entry[:2]
+            else:
+                entry = None
+
+        if entry is None:
+            row = self._db().execute('SELECT value, expires FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            data, expires = str(row[0]), row[1]
+            if self._alive(expires):
+                self._remember(key, data, expires)
+
+        if not self._alive(expires):
+            self._forget(key)
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def set(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self._expires(timeout)
+        self._db().execute('INSERT OR REPLACE INTO entries (key, value, expires, stored) VALUES (?, ?, ?, ?)',
+                           (key, sqlite3.Binary(data), expires, time.time()))
+        self._remember(key, data, expires)
+        self._prune()
+        return True
+
+    def add(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self._expires(timeout)
+        db = self._db()
+        db.execute('DELETE FROM entries WHERE key = ? AND expires > 0 AND expires <= ?', (key, time.time()))
+        added = db.execute('INSERT OR IGNORE INTO entries (key, value, expires, stored) VALUES (?, ?, ?, ?)',
+                           (key, sqlite3.Binary(data), expires, time.time())).rowcount > 0
+        if added:
+            self._remember(key, data, expires)
+            self._prune()
+        return added
+
+    def delete(self, key):
+        self._forget(key)
+        self._db().execute('DELETE FROM entries WHERE key = ?', (key,))
+        return True
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self.__lock:
+            self.__lru.clear()
+        self._db().execute('DELETE FROM entries')
+        return True
+
+    def dump(self):
+        """
+        Yields the (key, pickled value, expires, stored) entries still alive, newest first, leaving
+        out lock entries, which only mean something to the processes that took them.
+        """
+        rows = self._db().execute('SELECT key, value, expires, stored FROM entries '
+                                  'WHERE expires = 0 OR expires > ? ORDER BY stored DESC', (time.time(),))
+        for key, data, expires, stored in rows:
+            if not key.endswith((FLIGHT, REFRESH)):
+                yield key, str(data), expires, stored
+
+    def load(self, entries, hashed=False):
+        """
+        Inserts (key, pickled value, expires, stored) entries in a single transaction, keeping those
+        the store already holds, and prunes the store once. Returns how many were inserted.
+        """
+        if hashed:
+            raise ValueError('entries with hashed keys cannot be loaded into a tiered cache')
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            before = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO entries (key, value, expires, stored) VALUES (?, ?, ?, ?)',
+                           ((key, sqlite3.Binary(data), expires, stored) for key, data, expires, stored in entries))
+            loaded = db.total_changes - before
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        if loaded:
+            self._evict()
+        return loaded
+
+
+class FileSystemCache(_FileSystemCache):
+    """
+    Werkzeug's file system cache, reporting the entries its pruning removes.
+    """
+    # Only the hashes of keys are kept, as file names
+    hashed_keys = True
+    on_evict = None
+
+    def _prune(self):
+        before = self._file_count
+        _FileSystemCache._prune(self)
+        if self.on_evict is not None and before > self._threshold:
+            self.on_evict(max(before - self._file_count, 0))
+
+    def dump(self):
+        """
+        Yields the (file name, pickled value, expires, stored) entries still alive. This cache is not
+        shared, so it holds no lock entries.
+        """
+        now = time.time()
+        for filename in self._list_dir():
+            try:
+                with open(filename, 'rb') as f:
+                    expires = pickle.load(f)
+                    data = f.read()
+                stored = os.path.getmtime(filename)
+            except (IOError, OSError, pickle.PickleError):
+                # Pruned or expired meanwhile
+                continue
+            if expires == 0 or expires > now:
+                yield os.path.basename(filename), data, expires, stored
+
+    def load(self, entries, hashed=False):
+        """
+        Writes (key, pickled value, expires, stored) entries, or (file name, ...) ones if hashed,
+        keeping those the cache already holds, and prunes the cache once. Returns how many were written.
+        """
+        loaded = 0
+        for key, data, expires, stored in entries:
+            filename = os.path.join(self._path, os.path.basename(key)) if hashed else self._get_filename(key)
+            if os.path.exists(filename):
+                continue
+            try:
+                fd, tmp = tempfile.mkstemp(suffix=self._fs_transaction_suffix, dir=self._path)
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(int(expires), f, 1)
+                    f.write(data)
+                os.utime(tmp, (stored, stored))
+                os.rename(tmp, filename)
+                os.chmod(filename, self._mode)
+            except (IOError, OSError):
+                continue
+            loaded += 1
+        if loaded:
+            self._update_count(delta=loaded)
+            self._prune()
+        return loaded
+
+
+class InstrumentedCache(object):
+    """
+    Proxy of a cache backend that counts its hits, misses and evictions under a cache name.
+    """
+
+    def __init__(self, backend, name):
+        self.__backend = backend
+        self.__name = name
+        if hasattr(backend, 'on_evict'):
+            backend.on_evict = lambda n: metrics.cache_evictions.inc(n, cache=name)
+
+    def get(self, key):
+        rv = self.__backend.get(key)
+        self.count(rv is not None)
+        return rv
+
+    def peek(self, key):
+        """
+        Gets key without counting it, for probes and lock reads that are no lookups of their own.
+        """
+        return self.__backend.get(key)
+
+    def count(self, hit):
+        metrics.cache_requests.inc(cache=self.__name, result='hit' if hit else 'miss')
+
+    def __getattr__(self, item):
+        return getattr(self.__backend, item)
+
+
+# Instrumented cache backends by name
+backends = OrderedDict()
+
+
+def peek(backend, key):
+    """
+    Gets key from a cache backend without counting a lookup if the backend is instrumented.
+    """
+    return backend.peek(key) if isinstance(backend, InstrumentedCache) else backend.get(key)
+
+
+def count_lookup(backend, hit):
+    """
+    Counts a lookup that was made with peek.
+    """
+    if isinstance(backend, InstrumentedCache):
+        backend.count(hit)
+
+
+def instrument(cache, name):
+    """
+    Puts the backend of a Flask-Cache cache behind an InstrumentedCache.
+    """
+    extensions = cache.app.extensions['cache']
+    extensions[cache] = backends[name] = InstrumentedCache(extensions[cache], name)
+
+
+def filesystem(app, config, args, kwargs):
+    """
+    Flask-Cache backend factory: CACHE_TYPE = 'kg_search.caching.filesystem'.
+    """
+    args.insert(0, config['CACHE_DIR'])
+    kwargs.update(dict(threshold=config['CACHE_THRESHOLD']))
+    return FileSystemCache(*args, **kwargs)
+
+
+def tiered(app, config, args, kwargs):
+    """
+    Flask-Cache backend factory: CACHE_TYPE = 'kg_search.caching.tiered'. The store lives in
+    <CACHE_DIR>.db, holds up to CACHE_THRESHOLD entries and is fronted by an LRU of
+    CACHE_LRU_SIZE entries, each trusted for CACHE_LRU_TTL seconds.
+    """
+    kwargs.update(dict(threshold=config['CACHE_THRESHOLD'], lru_size=config.get('CACHE_LRU_SIZE', 1024),
+                       lru_ttl=config.get('CACHE_LRU_TTL', 5)))
+    args.insert(0, config['CACHE_DIR'] + '.db')
+    return TieredCache(*args, **kwargs)
+
+
+# Memoized entries are (status, value, fresh until, expires) tuples. Degraded values were computed
+# falling back from failures
+VALUE, EMPTY, DEGRADED, FAILURE = 'value', 'empty', 'degraded', 'failure'
+MISS = object()
+RAISE = object()
+
+_refreshing = set()
+_refreshing_lock = Lock()
+
+_context = local()
+
+
+class Outcome(object):
+    """
+    Whether some work fell back from a failed call, which leaves its results degraded.
+    """
+
+    def __init__(self):
+        self.degraded = False
+
+
+@contextmanager
+def tracking(*outcomes):
+    """
+    Failures this thread falls back from within the context degrade the outcomes (objects with a
+    `degraded` attribute, like Outcome), and those tracked around the context as well.
+    """
+    stack = getattr(_context, 'outcomes', None)
+    if stack is None:
+        stack = _context.outcomes = []
+    stack.extend(outcomes)
+    try:
+        yield
+    finally:
+        for outcome in outcomes:
+            if outcome in stack:
+                stack.remove(outcome)
+
+
+def tracked():
+    """
+    The outcomes this thread is tracking, for the work it hands over to other threads.
+    """
+    return tuple(getattr(_context, 'outcomes', ()))
+
+
+def degrade():
+    """
+    Marks the outcomes this thread is tracking as degraded.
+    """
+    for outcome in getattr(_context, 'outcomes', ()):
+        outcome.degraded = True
+
+
+class CachedFailure(Exception):
+    """
+    A memoized call failed recently and is not retried until its failure entry expires.
+    """
+
+
+def rebased(data, shift):
+    """
+    A pickled cache value with the freshness and expiry of a memoized entry moved shift seconds.
+    """
+    try:
+        value = pickle.loads(data)
+    except Exception:
+        return data
+    if isinstance(value, tuple) and len(value) == 4 and value[0] in (VALUE, EMPTY, DEGRADED, FAILURE):
+        status, value, fresh_until, expires = value
+        return pickle.dumps((status, value, fresh_until + shift, expires + shift), pickle.HIGHEST_PROTOCOL)
+    return data
+
+
+def _normalized(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(_normalized(v) for v in value)
+    if isinstance(value, dict):
+        return sorted((k, _normalized(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_normalized(v) for v in value]
+    return value
+
+
+def memoize(cache, timeout, fresh=None, empty_timeout=EMPTY_TIMEOUT, failure_timeout=FAILURE_TIMEOUT, failure=RAISE,
+            make_name=None, canonical=None):
+    """
+    Memoizes a function in a Flask-Cache cache. Results stay for `timeout` seconds, but after `fresh`
+    seconds (a tenth of it by default) they are served stale while refreshed in the background.
+    Empty results are only kept for `empty_timeout` seconds. A call that raises is not retried for
+    `failure_timeout` seconds: meanwhile its callers get `failure`, which degrades the outcomes they
+    are tracking, or a CachedFailure if not given. Results that are degraded by such fallbacks
+    within the call are only kept for `failure_timeout` seconds, and degrade their callers too.
+    Calls that were throttled before reaching their provider are raised and not remembered.
+    Background refreshes are admitted upstream last.
+    `canonical` maps argument names to functions of kg_search.canonical that are applied to them in
+    cache keys, so that equivalent calls share their entry.
+    Like Flask-Cache's memoize, the decorated function has `uncached`, `cache_timeout` and
+    `make_cache_key`, plus `cached(*args)`, which returns MISS when nothing is cached without counting a lookup, and
+    `store(value, *args)`.
+    """
+    if fresh is None:
+        fresh = timeout // 10
+
+    def decorator(f):
+        name = '{}.{}'.format(f.__module__, make_name(f.__name__) if make_name else f.__name__)
+
+        def make_cache_key(fn, *args, **kwargs):
+            # Bound by name against the function itself, not a (*args, **kwargs) wrapper of it
+            while hasattr(fn, '__wrapped__'):
+                fn = fn.__wrapped__
+            call = canonical_arguments(inspect.getcallargs(fn, *args, **kwargs), canonical)
+            return 'memo:{}:{}'.format(name, hashlib.sha1(repr(_normalized(call))).hexdigest())
+
+        def put(key, status, value, fresh_for, expires_in):
+            now = time.time()
+            cache.cache.set(key, (status, value, now + fresh_for, now + expires_in), timeout=expires_in)
+
+        def put_result(key, value, degraded=False):
+            if degraded:
+                put(key, DEGRADED, value, failure_timeout, failure_timeout)
+            elif value:
+                put(key, VALUE, value, fresh, timeout)
+            else:
+                put(key, EMPTY, value, empty_timeout, empty_timeout)
+
+        def keep_stale(key, entry):
+            # Keep serving the stale value, and try again no sooner than a failure would be retried
+            status, value, _, expires = entry
+            put(key, status, value, failure_timeout, max(int(expires - time.time()), failure_timeout))
+
+        def refresh(key, args, kwargs, entry):
+            outcome = Outcome()
+            try:
+                with upstream.priority(upstream.BACKGROUND), tracking(outcome):
+                    rv = f(*args, **kwargs)
+                if outcome.degraded:
+                    log.warning('refresh of %s fell back from failures', name)
+                    keep_stale(key, entry)
+                else:
+                    put_result(key, rv)
+            except Exception:
+                log.warning('refresh of %s failed', name, exc_info=True)
+                keep_stale(key, entry)
+            finally:
+                with _refreshing_lock:
+                    _refreshing.discard(key)
+                if getattr(cache.cache, 'shared', False):
+                    cache.cache.delete(key + REFRESH)
+
+        def revalidate(key, args, kwargs, entry):
+            with _refreshing_lock:
+                if key in _refreshing:
+                    return
+                _refreshing.add(key)
+            if getattr(cache.cache, 'shared', False) and not cache.cache.add(key + REFRESH, os.getpid(),
+                                                                             timeout=failure_timeout):
+                with _refreshing_lock:
+                    _refreshing.discard(key)
+                return
+            refresh_pool.submit(refresh, key, args, kwargs, entry)
+
+        def lookup(key, args, kwargs, counted=True):
+            entry = peek(cache.cache, key)
+            if counted:
+                count_lookup(cache.cache, entry is not None)
+            if entry is None:
+                return MISS
+            status, value, fresh_until, _ = entry
+            if status == FAILURE:
+                if failure is RAISE:
+                    raise CachedFailure(value)
+                degrade()
+                return copy.copy(failure)
+            if status == DEGRADED:
+                degrade()
+            elif fresh_until <= time.time():
+                revalidate(key, args, kwargs, entry)
+            return value
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = make_cache_key(f, *args, **kwargs)
+            rv = lookup(key, args, kwargs)
+            if rv is not MISS:
+                return rv
+
+            # Tracked within the callers' outcomes, which are degraded along with it
+            outcome = Outcome()
+            try:
+                with tracking(outcome):
+                    rv = f(*args, **kwargs)
+            except upstream.Throttled:
+                # It was never sent, so there is no failure of the provider to remember
+                raise
+            except Exception as e:
+                put(key, FAILURE, '{}: {!r}'.format(name, e), failure_timeout, failure_timeout)
+                if failure is RAISE:
+                    raise
+                log.warning('%s failed', name, exc_info=True)
+                degrade()
+                return copy.copy(failure)
+
+            put_result(key, rv, outcome.degraded)
+            return rv
+
+        def cached(*args, **kwargs):
+            key = make_cache_key(f, *args, **kwargs)
+            return lookup(key, args, kwargs, counted=False)
+
+        def store(value, *args, **kwargs):
+            put_result(make_cache_key(f, *args, **kwargs), value)
+
+        decorated_function.uncached = f
+        decorated_function.cache_timeout = timeout
+        decorated_function.make_cache_key = make_cache_key
+        decorated_function.cached = cached
+        decorated_function.store = store
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,95 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import unicodedata
+import urllib
+import urlparse
+
+__author__ = 'Fernando Serena'
+
+# What MediaWiki leaves unescaped in article URLs, as Wikidata sitelinks have them
+WIKI_SAFE = "/;:@$!*(),~"
+
+
+def _unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def text(value):
+    """
+    NFC form of a text with its whitespace collapsed. Case is kept.
+    """
+    if not value:
+        return value
+    return u' '.join(unicodedata.normalize('NFC', _unicode(value)).split())
+
+
+def folded(value):
+    """
+    Canonical text for services that do not tell case apart.
+    """
+    value = text(value)
+    return value.lower() if value else value
+
+
+def types(values):
+    """
+    Sorted types without duplicates.
+    """
+    if values is None:
+        return None
+    if isinstance(values, basestring):
+        values = [values]
+    return sorted(set(values))
+
+
+def url(value):
+    """
+    URL with its scheme and host in lower case, a path and no fragment.
+    """
+    parts = urlparse.urlsplit(_unicode(value).strip())
+    return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', parts.query, ''))
+
+
+def wiki(value):
+    """
+    Wikipedia article URL encoded the way Wikidata links it: whatever the URL came with,
+    its path is unquoted and then quoted again like MediaWiki does.
+    """
+    value = _unicode(value).strip().encode('utf-8')
+    parts = urlparse.urlsplit(value)
+    path = urllib.quote(urllib.unquote(parts.path), safe=WIKI_SAFE)
+    return urlparse.urlunsplit((parts.scheme, parts.netloc.lower(), path, parts.query, ''))
+
+
+def arguments(call, rules):
+    """
+    The arguments of a call (as inspect.getcallargs gives them) with the rules for them applied.
+    """
+    if not rules:
+        return call
+    call = dict(call)
+    for name, rule in rules.items():
+        if name in call:
+            call[name] = rule(call[name])
+    return call
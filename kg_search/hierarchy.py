@@ -0,0 +1,108 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import atexit
+import json
+import os
+from threading import Lock
+
+__author__ = 'Fernando Serena'
+
+
+class ClassHierarchy(object):
+    """
+    Table of Wikidata classes to the schema.org types they close to over P279* and P1709, filled in
+    incrementally and persisted as JSON so that it stays warm across restarts.
+    """
+
+    def __init__(self, path=None, save_every=100):
+        self.path = path
+        self.save_every = save_every
+        self.__types = {}
+        self.__dirty = 0
+        self.__lock = Lock()
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    def __len__(self):
+        return len(self.__types)
+
+    def __contains__(self, cls):
+        return cls in self.__types
+
+    def get(self, cls):
+        return self.__types.get(cls)
+
+    def missing(self, classes):
+        return [cls for cls in set(classes) if cls not in self.__types]
+
+    def types(self, classes):
+        """
+        Union of the schema.org types of the given classes, all of which must be known.
+        """
+        types = set()
+        for cls in set(classes):
+            types.update(self.__types[cls])
+        return types
+
+    def update(self, class_types):
+        with self.__lock:
+            for cls, types in class_types.items():
+                self.__types[cls] = frozenset(types)
+            self.__dirty += len(class_types)
+            save = self.path and self.__dirty >= self.save_every
+        if save:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            return
+        with self.__lock:
+            for cls, types in stored.items():
+                self.__types.setdefault(cls, frozenset(types))
+
+    def save(self):
+        """
+        Merges the table into the stored one (other processes may have saved theirs) and atomically replaces it.
+        Nothing is written if the table did not change since it was last saved.
+        """
+        if not self.path or not self.__dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another process meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        self.load()
+        with self.__lock:
+            stored = {cls: sorted(types) for cls, types in self.__types.items()}
+            self.__dirty = 0
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(stored, f)
+        os.rename(tmp, self.path)
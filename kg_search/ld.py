@@ -18,52 +18,70 @@
   limitations under the License.
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
+import hashlib
+import json
 from datetime import datetime
 from rfc822 import mktime_tz, parsedate_tz
+from threading import Lock
 
 import isodate
 import shortuuid
 from pyld import jsonld
-from rdflib import URIRef, XSD, RDFS, Graph
+from rdflib import URIRef, XSD, RDF, RDFS, Graph
 from rdflib.term import Literal, BNode
 
 __author__ = 'Fernando Serena'
 
+_contexts = {}
+_contexts_lock = Lock()
 
-def ld_triples(ld, g=None):
+
+def _document_loader(url, *args):
+    # Remote contexts are fetched once per process
+    with _contexts_lock:
+        if url not in _contexts:
+            _contexts[url] = jsonld.get_document_loader()(url, *args)
+        return _contexts[url]
+
+
+def _literal(value, datatype=None, lang=None):
+    if datatype == XSD.dateTime:
+        try:
+            value = float(value)
+            value = datetime.utcfromtimestamp(value)
+        except:
+            try:
+                value = isodate.parse_datetime(value)
+            except:
+                timestamp = mktime_tz(parsedate_tz(value))
+                value = datetime.fromtimestamp(timestamp)
+    if datatype == RDFS.Literal:
+        datatype = None
+        try:
+            value = float(value)
+        except:
+            pass
+    if datatype is not None:
+        lang = None
+    return Literal(value, datatype=datatype, lang=lang)
+
+
+def _normalized_triples(ld, g):
     bid_map = {}
 
     def parse_term(term):
         if term['type'] == 'IRI':
             return URIRef(term['value'])
         elif term['type'] == 'literal':
-            datatype = URIRef(term.get('datatype', None))
-            if datatype == XSD.dateTime:
-                try:
-                    term['value'] = float(term['value'])
-                    term['value'] = datetime.utcfromtimestamp(term['value'])
-                except:
-                    try:
-                        term['value'] = isodate.parse_datetime(term['value'])
-                    except:
-                        timestamp = mktime_tz(parsedate_tz(term['value']))
-                        term['value'] = datetime.fromtimestamp(timestamp)
-            if datatype == RDFS.Literal:
-                datatype = None
-                try:
-                    term['value'] = float(term['value'])
-                except:
-                    pass
-            return Literal(term['value'], datatype=datatype)
+            datatype = term.get('datatype', None)
+            return _literal(term['value'], datatype=URIRef(datatype) if datatype else None)
         else:
             bid = term['value'].split(':')[1]
             if bid not in bid_map:
                 bid_map[bid] = shortuuid.uuid()
             return BNode(bid_map[bid])
 
-    if g is None:
-        g = Graph()
-    norm = jsonld.normalize(ld)
+    norm = jsonld.normalize(ld, {'documentLoader': _document_loader})
     def_graph = norm.get('@default', [])
     for triple in def_graph:
         subject = parse_term(triple['subject'])
@@ -73,4 +91,88 @@ def ld_triples(ld, g=None):
         object = parse_term(triple['object'])
         g.add((subject, predicate, object))
 
+
+class _TripleEmitter(object):
+    """
+    Walks an expanded JSON-LD document and adds its default graph triples to g.
+    Blank nodes are labelled after a digest of the document, so the same payload
+    always yields the same labels.
+    """
+
+    def __init__(self, ld, g):
+        self.g = g
+        self.prefix = hashlib.sha1(json.dumps(ld, sort_keys=True)).hexdigest()[:12]
+        self.bnodes = {}
+
+    def bnode(self, bid=None):
+        if bid is None:
+            bid = len(self.bnodes)
+        if bid not in self.bnodes:
+            self.bnodes[bid] = BNode('{}b{}'.format(self.prefix, len(self.bnodes)))
+        return self.bnodes[bid]
+
+    def node_term(self, node_id):
+        if node_id is None or node_id.startswith('_:'):
+            return self.bnode(node_id)
+        return URIRef(node_id)
+
+    def value(self, value):
+        if '@list' in value:
+            return self.list(value['@list'])
+        if '@value' not in value:
+            return self.node(value)
+
+        v = value['@value']
+        datatype = value.get('@type', None)
+        if isinstance(v, bool):
+            datatype = datatype or XSD.boolean
+        elif isinstance(v, (int, long)):
+            datatype = datatype or XSD.integer
+        elif isinstance(v, float):
+            datatype = datatype or XSD.double
+        elif '@language' not in value:
+            datatype = datatype or XSD.string
+        return _literal(v, datatype=URIRef(datatype) if datatype else None, lang=value.get('@language', None))
+
+    def list(self, items):
+        nodes = [self.bnode() for _ in items]
+        for node, rest, item in zip(nodes, nodes[1:] + [RDF.nil], items):
+            self.g.add((node, RDF.first, self.value(item)))
+            self.g.add((node, RDF.rest, rest))
+        return nodes[0] if nodes else RDF.nil
+
+    def node(self, node):
+        subject = self.node_term(node.get('@id', None))
+        for ty in node.get('@type', []):
+            self.g.add((subject, RDF.type, self.node_term(ty)))
+        for prop, values in node.items():
+            if prop.startswith('@') or not prop.startswith('http'):
+                continue
+            predicate = URIRef(prop)
+            for value in values:
+                self.g.add((subject, predicate, self.value(value)))
+        return subject
+
+    def emit(self, expanded):
+        for node in expanded:
+            if '@graph' in node and '@id' not in node:
+                self.emit(node['@graph'])
+            else:
+                self.node(node)
+
+
+def ld_triples(ld, g=None, normalize=False):
+    """
+    Adds the triples of a JSON-LD document to g (a new Graph by default).
+    With normalize=True, the document goes through URDNA2015 canonicalization first.
+    """
+    if g is None:
+        g = Graph()
+
+    if normalize:
+        _normalized_triples(ld, g)
+    else:
+        expanded = jsonld.expand(ld, {'documentLoader': _document_loader})
+        _TripleEmitter(ld, g).emit(expanded)
+
     return g
@@ -0,0 +1,166 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import bisect
+import time
+from functools import wraps
+from threading import Lock
+
+__author__ = 'Fernando Serena'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)) + '}'
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """
+    Monotonic counter of the current process, one series per combination of label values.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.__values = {}
+        self.__lock = Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def samples(self):
+        with self.__lock:
+            values = sorted(self.__values.items())
+        for key, value in values:
+            yield self.name, _labels(self.labels, key), value
+
+
+class Histogram(object):
+    """
+    Histogram of observations of the current process, one series per combination of label values.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.__values = {}
+        self.__lock = Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            series = self.__values.get(key, None)
+            if series is None:
+                series = self.__values[key] = [[0] * len(self.buckets), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, **labels):
+        """
+        Decorator that observes the duration of every call.
+        """
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(time.time() - start, **labels)
+
+            # What functools.wraps sets on Python 3, so that the arguments of calls can still be bound by name
+            wrapper.__wrapped__ = f
+            return wrapper
+
+        return decorator
+
+    def samples(self):
+        with self.__lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.__values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + '_bucket', _labels(self.labels + ('le',), key + (_number(bound),)), cumulative
+            yield self.name + '_sum', _labels(self.labels, key), total
+            yield self.name + '_count', _labels(self.labels, key), cumulative
+
+
+def exposition():
+    """
+    All metrics of this process in the Prometheus text format. With several worker processes,
+    each scrape reports the worker that happens to serve it.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('{}{} {}'.format(name, labels, _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram('kg_search_stage_seconds', 'Time spent in each stage of a search.', ['stage'])
+expansion_depth = Histogram('kg_search_expansion_depth', 'Depth reached by KG expansions.',
+                            buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10))
+upstream_seconds = Histogram('kg_search_upstream_seconds', 'Latency of upstream requests.', ['host'])
+upstream_requests = Counter('kg_search_upstream_requests_total', 'Upstream requests by response status.',
+                            ['host', 'status'])
+upstream_queue_seconds = Histogram('kg_search_upstream_queue_seconds',
+                                   'Time upstream requests waited to be admitted by their provider.', ['provider'])
+upstream_throttled = Counter('kg_search_upstream_throttled_total',
+                             'Upstream requests given up after waiting too long to be admitted.', ['provider'])
+upstream_retries = Counter('kg_search_upstream_retries_total', 'Upstream requests retried after 429 or 503.',
+                           ['provider'])
+cache_requests = Counter('kg_search_cache_requests_total', 'Cache lookups by result.', ['cache', 'result'])
+cache_evictions = Counter('kg_search_cache_evictions_total', 'Entries evicted from caches.', ['cache'])
+
+
+def stage(name):
+    return stage_seconds.time(stage=name)
@@ -1,72 +1,284 @@
 import base64
+import hashlib
 import json
-import traceback
-import urllib
+import logging
 import urlparse
 from urllib import quote, unquote
-import shelve
 import os
-import requests
+import re
 import sys
-from SPARQLWrapper import JSON
-from SPARQLWrapper import SPARQLWrapper
-from StringIO import StringIO
+import time
+from Queue import Queue
+from collections import Counter
+from io import BytesIO
 from rdflib import Graph, Namespace, URIRef
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from functools import wraps
+from threading import Event, Lock, local
 
 from kg_search.ld import ld_triples
-from kg_search import kg_cache, wd_cache, wp_cache, dn_cache, app
-from difflib import SequenceMatcher
+from kg_search.similarity import Query
+from kg_search.hierarchy import ClassHierarchy
+from kg_search.wdindex import WikidataIndex
+from kg_search import kg_cache, wd_cache, wp_cache, dn_cache, vs_cache, app, upstream, canonical, GREEN, CACHE_ROOT
+from kg_search.caching import memoize, MISS, EMPTY_TIMEOUT, FLIGHT, Outcome, tracking, tracked, degrade, peek, \
+    count_lookup
+from kg_search.metrics import stage, expansion_depth
 import wikipedia
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# wikipedia issues its own requests.get calls, send them through the shared session too
+wikipedia.wikipedia.requests = upstream
+
 SCHEMA = Namespace('http://schema.org/')
+log = logging.getLogger(__name__)
+
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
 DANDELION_API_KEY = os.environ.get('DANDELION_API_KEY')
 if not GOOGLE_API_KEY:
     sys.exit(-1)
 
-wiki_d = shelve.open('wiki-entities')
-
-pool = ThreadPoolExecutor()
-
-
-def similar(a, b):
-    return SequenceMatcher(None, a, b).ratio()
-
-
-@wd_cache.memoize(864000)
+KG_SEARCH_API = os.environ.get('KG_SEARCH_API', 'https://kgsearch.googleapis.com/v1/entities:search')
+VISION_API = os.environ.get('VISION_API', 'https://vision.googleapis.com/v1/images:annotate')
+DANDELION_NEX_API = os.environ.get('DANDELION_NEX_API', 'https://api.dandelion.eu/datatxt/nex/v1')
+WIKIPEDIA_API = os.environ.get('WIKIPEDIA_API')
+WIKIDATA_SPARQL = os.environ.get('WIKIDATA_SPARQL', 'https://query.wikidata.org/sparql')
+DBPEDIA_SPARQL = os.environ.get('DBPEDIA_SPARQL', 'http://dbpedia.org/sparql')
+SPARQL_BATCH_SIZE = int(os.environ.get('SPARQL_BATCH_SIZE', 50))
+NEX_CHUNK_SIZE = int(os.environ.get('NEX_CHUNK_SIZE', 2000))
+# Base64 inflates by 4/3, and Vision takes requests of up to 10 MB
+MAX_IMAGE_SIZE = int(os.environ.get('MAX_IMAGE_SIZE', 7 * 1024 * 1024))
+WIKIDATA_INDEX = os.environ.get('WIKIDATA_INDEX')
+WIKIDATA_CLASSES = os.environ.get('WIKIDATA_CLASSES', os.path.join(CACHE_ROOT, 'wikidata-classes.json'))
+
+_IRI_REF = re.compile(r'^[^<>"{}|^`\\\x00-\x20]+$')
+_QID = re.compile(r'^Q[0-9]+$')
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+', re.UNICODE)
+
+if WIKIPEDIA_API:
+    wikipedia.wikipedia.API_URL = WIKIPEDIA_API
+
+upstream.provider('kg', KG_SEARCH_API, rate=10, concurrency=16)
+upstream.provider('vision', VISION_API, rate=20, concurrency=16)
+upstream.provider('nex', DANDELION_NEX_API, rate=10, concurrency=8)
+upstream.provider('wikipedia', wikipedia.wikipedia.API_URL, rate=20, concurrency=8)
+upstream.provider('wikidata', WIKIDATA_SPARQL, rate=5, concurrency=5)
+upstream.provider('dbpedia', DBPEDIA_SPARQL, rate=20, concurrency=16)
+
+pool = ThreadPoolExecutor(max_workers=upstream.POOL_SIZE)
+wd_index = WikidataIndex(WIKIDATA_INDEX) if WIKIDATA_INDEX else None
+class_hierarchy = ClassHierarchy(WIKIDATA_CLASSES)
+kg_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('KG_SEARCH_WORKERS', 64 if GREEN else 8)))
+names_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('NAME_SEARCH_WORKERS', 64 if GREEN else 8)))
+
+
+_scope = local()
+
+
+class CallScope(object):
+    """
+    Shares the results of identical upstream calls among all the work done within the scope,
+    e.g. the jobs of a batch search, including calls that are still in flight.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__calls = {}
+
+    def call(self, f, *args, **kwargs):
+        key = f.make_cache_key(f.uncached, *args, **kwargs)
+        with self.__lock:
+            future = self.__calls.get(key, None)
+            owner = future is None
+            if owner:
+                future = self.__calls[key] = Future()
+
+        if owner:
+            outcome = Outcome()
+            try:
+                with tracking(outcome):
+                    rv = f(*args, **kwargs)
+                future.degraded = outcome.degraded
+                future.set_result(rv)
+            except Exception:
+                future.set_exception_info(*sys.exc_info()[1:])
+            return future.result()
+        return _shared_result(future)
+
+    @staticmethod
+    def current():
+        stack = getattr(_scope, 'stack', None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        if not hasattr(_scope, 'stack'):
+            _scope.stack = []
+        _scope.stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _scope.stack.pop()
+
+
+def _shared_result(future):
+    """
+    The result of a call made by someone else, whose fallback from a failure degrades this thread's outcomes too.
+    """
+    rv = future.result()
+    if getattr(future, 'degraded', False):
+        degrade()
+    return rv
+
+
+def shared(f):
+    """
+    Routes the calls to a memoized upstream function through the current CallScope, if any.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        scope = CallScope.current()
+        if scope is None:
+            return f(*args, **kwargs)
+        return scope.call(f, *args, **kwargs)
+
+    return wrapper
+
+
+_flights = {}
+_flights_lock = Lock()
+
+
+def single_flight(cache, lock_timeout=60, poll=0.05):
+    """
+    Coalesces concurrent calls to a function memoized in cache that share a cache key: one caller
+    fetches while the rest wait for its result. If the cache backend is shared between processes,
+    a lock entry extends this to other workers, whose callers wait for the value to be cached.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            backend = cache.cache
+            rv = f.cached(*args, **kwargs)
+            if rv is not MISS:
+                # The probe is not counted, but here it answers the call; misses are counted by f
+                count_lookup(backend, True)
+                return rv
+            key = f.make_cache_key(f.uncached, *args, **kwargs)
+
+            with _flights_lock:
+                flight = _flights.get(key, None)
+                leader = flight is None
+                if leader:
+                    flight = _flights[key] = Future()
+            if not leader:
+                return _shared_result(flight)
+
+            lock_key = key + FLIGHT
+            locked = False
+            try:
+                if getattr(backend, 'shared', False):
+                    locked = backend.add(lock_key, os.getpid(), timeout=lock_timeout)
+                    deadline = time.time() + lock_timeout
+                    while not locked and peek(backend, key) is None and time.time() < deadline:
+                        time.sleep(poll)
+                        locked = backend.add(lock_key, os.getpid(), timeout=lock_timeout)
+                outcome = Outcome()
+                with tracking(outcome):
+                    rv = f(*args, **kwargs)
+                flight.degraded = outcome.degraded
+                flight.set_result(rv)
+            except Exception:
+                flight.set_exception_info(*sys.exc_info()[1:])
+            finally:
+                with _flights_lock:
+                    del _flights[key]
+                if locked:
+                    backend.delete(lock_key)
+            return flight.result()
+
+        return wrapper
+
+    return decorator
+
+
+def local_first(lookup):
+    """
+    Answers with lookup(*args) whenever it knows the answer, before touching any cache or upstream service.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            rv = lookup(*args, **kwargs)
+            if rv is not None:
+                return rv
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _indexed_entity(wiki):
+    return wd_index.entity(wiki) if wd_index is not None else None
+
+
+def _indexed_types(entity):
+    return wd_index.types(entity) if wd_index is not None else None
+
+
+def submit(executor, fn, *args, **kwargs):
+    """
+    Submits fn to executor so that it runs within the caller's CallScope, upstream priority and
+    tracked outcomes.
+    """
+    scope = CallScope.current()
+    level = upstream.current_priority()
+    outcomes = tracked()
+
+    def scoped():
+        with upstream.priority(level), tracking(*outcomes):
+            if scope is None:
+                return fn(*args, **kwargs)
+            with scope:
+                return fn(*args, **kwargs)
+
+    return executor.submit(scoped)
+
+
+def _batches(items, size=SPARQL_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+@local_first(_indexed_entity)
+@shared
+@single_flight(wd_cache)
+@memoize(wd_cache, 864000, failure=None, canonical={'wiki': canonical.wiki})
+@stage('wikidata')
 def search_wiki_entity(wiki):
-    sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
-    sparql.setReturnFormat(JSON)
+    wiki = canonical.wiki(wiki)
 
-    try:
-        wiki = urllib.unquote(str(wiki))
-    except ValueError:
-        wiki = str(wiki
-                   )
-    wiki = wiki.replace("'", '%27')
-    wiki = wiki.replace("%28", '(')
-    wiki = wiki.replace("%29", ')')
-    wiki = wiki.replace("%3A", ":")
-    wiki = wiki.replace("%2C", ",")
-    sparql.setQuery("""
+    entity = None
+    results = upstream.sparql_select(WIKIDATA_SPARQL, """
        prefix schema: <http://schema.org/>
        SELECT * WHERE {
            <%s> schema:about ?item .
        }
    """ % wiki)
 
-    entity = None
-    try:
-        results = sparql.query().convert()
-
-        for result in results["results"]["bindings"]:
-            entity = result["item"]["value"].replace('http://www.wikidata.org/entity/', '')
-            if entity:
-                print u'found {} for {}'.format(entity, wiki)
-            break
-    except Exception:
-        pass
+    for result in results:
+        entity = result["item"]["value"].replace('http://www.wikidata.org/entity/', '')
+        if entity:
+            log.debug(u'found %s for %s', entity, wiki)
+        break
 
     if entity is None and 'https://' not in wiki:
         return search_wiki_entity(wiki.replace('http:', 'https:'))
@@ -74,6 +286,58 @@ def search_wiki_entity(wiki):
     return entity
 
 
+@stage('wikidata')
+def batch_search_wiki_entity(wikis):
+    """
+    Resolves many Wikipedia URLs to Wikidata entities with a few VALUES queries.
+    Every entity found is written to search_wiki_entity's cache.
+    """
+    entities = {}
+    articles = {}
+    failed = set()
+    for wiki in set(wikis):
+        entity = _indexed_entity(wiki) or search_wiki_entity.cached(wiki)
+        if entity is not MISS:
+            if entity is not None:
+                entities[wiki] = entity
+            continue
+        try:
+            article = canonical.wiki(wiki)
+        except UnicodeError:
+            continue
+        if not _IRI_REF.match(article):
+            continue
+        articles[article] = wiki
+        if 'https://' not in article:
+            articles[article.replace('http:', 'https:')] = wiki
+
+    for batch in _batches(articles):
+        try:
+            results = upstream.sparql_select(WIKIDATA_SPARQL, """
+               prefix schema: <http://schema.org/>
+               SELECT ?article ?item WHERE {
+                   VALUES ?article { %s }
+                   ?article schema:about ?item .
+               }
+           """ % ' '.join('<{}>'.format(article) for article in batch))
+        except Exception:
+            log.warning('Wikidata entity batch failed', exc_info=True)
+            failed.update(articles[article] for article in batch)
+            continue
+
+        for result in results:
+            wiki = articles.get(result["article"]["value"])
+            if wiki is not None and wiki not in entities:
+                entity = result["item"]["value"].replace('http://www.wikidata.org/entity/', '')
+                entities[wiki] = entity
+                search_wiki_entity.store(entity, wiki)
+
+    for wiki in set(articles.values()).difference(entities, failed):
+        search_wiki_entity.store(None, wiki)
+
+    return entities
+
+
 def search_dbpedia_uri(wiki):
     wiki = str(wiki)
     parse = urlparse.urlparse(wiki)
@@ -81,85 +345,241 @@ def search_dbpedia_uri(wiki):
     return 'http://dbpedia.org' + dbpedia_path
 
 
-@dn_cache.memoize(864000)
-def recognize_entities(q=None, url=None):
-    request_url = u'https://api.dandelion.eu/datatxt/nex/v1?token={}&'.format(DANDELION_API_KEY)
-    results = {}
+def text_chunks(text, size=NEX_CHUNK_SIZE):
+    """
+    Splits text into chunks of at most size characters made of whole sentences. Sentences
+    longer than that are split between words, or anywhere if a single word is.
+    """
+    chunk = u''
+    for sentence in _SENTENCE_END.split(text.strip()):
+        while len(sentence) > size:
+            cut = sentence.rfind(u' ', 0, size + 1)
+            if cut <= 0:
+                cut = size
+            if chunk:
+                yield chunk
+                chunk = u''
+            yield sentence[:cut].strip()
+            sentence = sentence[cut:].strip()
+        if chunk and len(chunk) + 1 + len(sentence) > size:
+            yield chunk
+            chunk = u''
+        chunk = u'{} {}'.format(chunk, sentence) if chunk else sentence
+    if chunk:
+        yield chunk
+
+
+@shared
+@single_flight(dn_cache)
+@memoize(dn_cache, 864000, failure={}, canonical={'text': canonical.text, 'url': canonical.url})
+@stage('nex')
+def _nex_annotations(text=None, url=None):
+    data = {'token': DANDELION_API_KEY}
     if url is not None:
-        request_url += u'url={}'.format(url)
+        data['url'] = url
     else:
-        request_url += u'text={}'.format(q)
+        data['text'] = text
 
-    response = requests.get(request_url)
+    response = upstream.post(DANDELION_NEX_API, data=data)
+    response.raise_for_status()
 
-    if response.status_code == 200:
-        data = response.json()
-        for an in data['annotations']:
-            wiki = an['uri']
-            if an['confidence'] > 0.5:
-                r = {
-                    'name': an.get('title'),
-                    'score': an.get('confidence')
-                }
+    results = {}
+    for an in response.json()['annotations']:
+        wiki = an['uri']
+        if an['confidence'] > 0.5:
+            r = {
+                'name': an.get('title'),
+                'score': an.get('confidence')
+            }
 
-                results[wiki] = r
+            results[wiki] = r
     return results
 
 
-@wd_cache.memoize(864000)
-def search_types_in_dbpedia(dbpedia_uri):
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setReturnFormat(JSON)
+def recognize_entities(q=None, url=None):
+    """
+    Recognizes the Wikipedia entities mentioned in a text, or in the page at url. Long texts are
+    recognized by chunks concurrently, each cached apart, and an entity mentioned in several of
+    them keeps its highest confidence. Chunks Dandelion did not admit in time recognize nothing.
+    """
 
-    sparql.setQuery("""           
-           SELECT * WHERE {
-               <%s> rdf:type ?type .
-           }
-       """ % dbpedia_uri)
+    def annotations(result):
+        try:
+            return result()
+        except upstream.Throttled:
+            log.warning('recognizing entities was throttled', exc_info=True)
+            degrade()
+            return {}
 
+    if url is not None:
+        return annotations(lambda: _nex_annotations(url=url))
+
+    chunks = list(text_chunks(q or u''))
+    if len(chunks) == 1:
+        return annotations(lambda: _nex_annotations(text=chunks[0]))
+
+    results = {}
+    for future in [submit(pool, _nex_annotations, text=chunk) for chunk in chunks]:
+        for wiki, r in annotations(future.result).items():
+            if wiki not in results or r['score'] > results[wiki]['score']:
+                results[wiki] = r
+    return results
+
+
+@shared
+@single_flight(wd_cache)
+@memoize(wd_cache, 864000, failure=set())
+@stage('dbpedia')
+def search_types_in_dbpedia(dbpedia_uri):
     types = set()
 
-    try:
-        results = sparql.query().convert()
+    results = upstream.sparql_select(DBPEDIA_SPARQL, """
+       SELECT * WHERE {
+           <%s> rdf:type ?type .
+       }
+   """ % dbpedia_uri)
 
-        for result in results["results"]["bindings"]:
-            ty = result["type"]["value"]
-            if ty.startswith('http://schema.org/'):
-                types.add(str(ty).replace('http://schema.org/', ''))
-    except Exception:
-        pass
+    for result in results:
+        ty = result["type"]["value"]
+        if ty.startswith('http://schema.org/'):
+            types.add(str(ty).replace('http://schema.org/', ''))
 
     return types
 
 
-@wd_cache.memoize(864000)
+@stage('dbpedia')
+def batch_search_types_in_dbpedia(dbpedia_uris):
+    """
+    Gets the schema.org types of many DBpedia resources with a few VALUES queries,
+    writing each resource's types to search_types_in_dbpedia's cache.
+    """
+    uri_types = {}
+    pending = []
+    for uri in set(dbpedia_uris):
+        types = search_types_in_dbpedia.cached(uri)
+        if types is not MISS:
+            uri_types[uri] = types
+        elif _IRI_REF.match(uri):
+            pending.append(uri)
+
+    for batch in _batches(pending):
+        try:
+            results = upstream.sparql_select(DBPEDIA_SPARQL, """
+               SELECT ?s ?type WHERE {
+                   VALUES ?s { %s }
+                   ?s rdf:type ?type .
+                   FILTER(STRSTARTS(STR(?type), "http://schema.org/"))
+               }
+           """ % ' '.join('<{}>'.format(uri) for uri in batch))
+        except Exception:
+            log.warning('DBpedia types batch failed', exc_info=True)
+            continue
+
+        batch_types = {uri: set() for uri in batch}
+        for result in results:
+            uri = result["s"]["value"]
+            if uri in batch_types:
+                batch_types[uri].add(str(result["type"]["value"]).replace('http://schema.org/', ''))
+
+        for uri, types in batch_types.items():
+            uri_types[uri] = types
+            search_types_in_dbpedia.store(types, uri)
+
+    return uri_types
+
+
+@local_first(_indexed_types)
+@shared
+@single_flight(wd_cache)
+@memoize(wd_cache, 864000, failure=set())
+@stage('wikidata')
 def search_types_in_wikidata(entity):
-    sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
-    sparql.setReturnFormat(JSON)
+    results = upstream.sparql_select(WIKIDATA_SPARQL, """
+       SELECT DISTINCT ?class WHERE {
+           wd:%s wdt:P31 ?class
+       }
+   """ % entity)
 
-    sparql.setQuery("""           
-           SELECT DISTINCT ?wd WHERE {
-               wd:%s wdt:P31/wdt:P279* ?super .
-               ?super wdt:P1709 ?wd
-           }
-       """ % entity)
+    return resolve_class_types([_wd_id(result["class"]["value"]) for result in results])
 
-    types = set()
 
-    try:
-        results = sparql.query().convert()
+def _wd_id(uri):
+    return uri.replace('http://www.wikidata.org/entity/', '')
 
-        for result in results["results"]["bindings"]:
-            s = result["wd"]["value"]
-            if s.startswith(SCHEMA):
-                types.add(s.replace(SCHEMA, ''))
-    except Exception:
-        pass
 
-    return types
+def resolve_class_types(classes):
+    """
+    Closes Wikidata classes over P279* up to their schema.org (P1709) types. Only the classes missing
+    from the class hierarchy table are queried, and their closure is added to it.
+    """
+    for batch in _batches(class_hierarchy.missing(cls for cls in classes if _QID.match(cls))):
+        results = upstream.sparql_select(WIKIDATA_SPARQL, """
+           SELECT DISTINCT ?class ?wd WHERE {
+               VALUES ?class { %s }
+               OPTIONAL {
+                   ?class wdt:P279* ?super .
+                   ?super wdt:P1709 ?wd
+               }
+           }
+       """ % ' '.join('wd:{}'.format(cls) for cls in batch))
+
+        batch_types = {cls: set() for cls in batch}
+        for result in results:
+            cls = _wd_id(result["class"]["value"])
+            s = result.get("wd", {}).get("value", '')
+            if cls in batch_types and s.startswith(SCHEMA):
+                batch_types[cls].add(s.replace(SCHEMA, ''))
+        class_hierarchy.update(batch_types)
+
+    return class_hierarchy.types(cls for cls in classes if cls in class_hierarchy)
+
+
+@stage('wikidata')
+def batch_search_types_in_wikidata(entities):
+    """
+    Gets the schema.org types of many Wikidata entities with a few VALUES queries,
+    writing each entity's types to search_types_in_wikidata's cache.
+    """
+    entity_types = {}
+    pending = []
+    for entity in set(entities):
+        types = _indexed_types(entity)
+        if types is None:
+            types = search_types_in_wikidata.cached(entity)
+        if types not in (None, MISS):
+            entity_types[entity] = types
+        elif _QID.match(entity or ''):
+            pending.append(entity)
+
+    for batch in _batches(pending):
+        try:
+            results = upstream.sparql_select(WIKIDATA_SPARQL, """
+               SELECT DISTINCT ?item ?class WHERE {
+                   VALUES ?item { %s }
+                   ?item wdt:P31 ?class
+               }
+           """ % ' '.join('wd:{}'.format(entity) for entity in batch))
+
+            batch_classes = {entity: set() for entity in batch}
+            for result in results:
+                entity = _wd_id(result["item"]["value"])
+                if entity in batch_classes:
+                    batch_classes[entity].add(_wd_id(result["class"]["value"]))
+            resolve_class_types(set.union(*batch_classes.values()))
+        except Exception:
+            log.warning('Wikidata types batch failed', exc_info=True)
+            continue
 
+        for entity, classes in batch_classes.items():
+            types = class_hierarchy.types(cls for cls in classes if cls in class_hierarchy)
+            entity_types[entity] = types
+            search_types_in_wikidata.store(types, entity)
 
-@wd_cache.memoize(8640000)
+    return entity_types
+
+
+@memoize(wd_cache, 8640000, canonical={'types': canonical.types})
+@stage('enrich')
 def enrich_wiki_entry(wiki, name, types):
     entity = search_wiki_entity(wiki)
     dbpedia = search_dbpedia_uri(wiki)
@@ -168,6 +588,17 @@ def enrich_wiki_entry(wiki, name, types):
     return types, entity, dbpedia
 
 
+def prefetch_enrichment(entries):
+    """
+    Batch-resolves the Wikidata entities and types of the (wiki, name, types) entries
+    that enrich_wiki_entry has not cached yet, so that enriching them only hits caches.
+    """
+    wikis = [wiki for wiki, name, types in entries
+             if enrich_wiki_entry.cached(wiki=wiki, name=name, types=types) is MISS]
+    if wikis:
+        batch_search_types_in_wikidata(batch_search_wiki_entity(wikis).values())
+
+
 def iriToUri(iri):
     parts = urlparse.urlparse(iri)
     return urlparse.urlunparse(
@@ -186,11 +617,10 @@ def median(lst):
         return sum(sorted(lst)[n // 2 - 1:n // 2 + 1]) / 2.0
 
 
-@kg_cache.memoize(864000)
-def _kg_request(q, types=None, count=None):
-    print u'querying "{}" with types {} [max {}] ...'.format(q, types, count)
-    kg_request_url = u'https://kgsearch.googleapis.com/v1/entities:search?query={}&key={}&indent=True'.format(
-        q, GOOGLE_API_KEY)
+@stage('kg_request')
+def _kg_response(q, types=None, count=None):
+    log.debug(u'querying "%s" with types %s [max %s] ...', q, types, count)
+    kg_request_url = u'{}?query={}&key={}&indent=True'.format(KG_SEARCH_API, q, GOOGLE_API_KEY)
 
     if count is not None:
         kg_request_url += '&limit={}'.format(count)
@@ -199,38 +629,103 @@ def _kg_request(q, types=None, count=None):
         types = ','.join(types)
         kg_request_url += '&types={}'.format(types)
 
-    kg_response = requests.get(kg_request_url)
+    kg_response = upstream.get(kg_request_url)
+    kg_response.raise_for_status()
+    return kg_response.json()
+
+
+def _ld_value(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get('@value')
+    return value
+
+
+def _ld_types(value):
+    if not isinstance(value, list):
+        value = [value] if value else []
+    return tuple(ty.split('/')[-1].split(':')[-1] for ty in value)
+
+
+@stage('kg_parse')
+def kg_records(data):
+    """
+    Extracts (score, wiki, name, types) records from a Knowledge Graph search response.
+    wiki is None for results that lack a detailed description.
+    """
+    records = []
+    for element in data.get('itemListElement', []):
+        score = element.get('resultScore')
+        if score is None:
+            continue
+        result = element.get('result', {})
+        wiki = _ld_value(result.get('detailedDescription', {}).get('url'))
+        name = _ld_value(result.get('name'))
+        records.append((float(score), wiki, name, _ld_types(result.get('@type'))))
+    return records
+
+
+@shared
+@single_flight(kg_cache)
+@memoize(kg_cache, 864000, failure=[], canonical={'q': canonical.folded, 'types': canonical.types})
+def _kg_request(q, types=None, count=None):
+    return kg_records(_kg_response(q, types=types, count=count))
+
 
+def kg_graph(q, types=None, count=None):
     kg = Graph()
     kg.bind('schema', SCHEMA)
-    ld_triples(kg_response.json(), kg)
-    # print kg.serialize(format='turtle')
-    return kg.serialize(format='turtle')
-
-
-def _kg_search(q, types=None, count=None, trace=None, source_q=None, ref_score=1.0):
-    if trace is None:
-        trace = []
-
+    ld_triples(_kg_response(q, types=types, count=count), kg)
+    return kg
+
+
+class SearchBudget(object):
+    """
+    Deadline and maximum number of KG lookups shared by all the expansions of a request. It tells
+    whether the request ran out of it, and, as an outcome, whether it fell back from failed calls:
+    either way its results may be incomplete.
+    """
+
+    def __init__(self, timeout=None, max_calls=None):
+        self.deadline = time.time() + timeout if timeout is not None else None
+        self.calls = max_calls
+        self.exhausted = False
+        self.degraded = False
+        self.__lock = Lock()
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def spend(self):
+        with self.__lock:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.exhausted = True
+                return False
+            if self.calls is not None:
+                if self.calls <= 0:
+                    self.exhausted = True
+                    return False
+                self.calls -= 1
+            return True
+
+
+@stage('kg_expand')
+def _kg_expand(q, types=None, count=None, source_q=None, ref_score=1.0):
+    """
+    Queries KG for q and returns its results together with the (name, types, source_q, score)
+    branches worth expanding next.
+    """
     if source_q is None:
         source_q = q
 
-    if (q, types) not in trace:
-        trace.append((q, types))
-    else:
-        return {}
+    records = _kg_request(q, types=types, count=count)
 
-    kg = Graph()
-    kg.parse(StringIO(_kg_request(q, types=types, count=count)), format='turtle')
-    kg_query_result = kg.query("""
-                        SELECT ?score WHERE {
-                           [] <http://schema.googleapis.com/resultScore> ?score
-                        }
-                    """)
-
-    scores = map(lambda x: x.score.toPython(), kg_query_result)
+    scores = [score for score, _, _, _ in records]
     if not scores:
-        return {}
+        return {}, []
 
     kgr_max_score = max(scores)
 
@@ -244,42 +739,40 @@ def _kg_search(q, types=None, count=None, trace=None, source_q=None, ref_score=1
 
     score_th = avg_score  # * 0.5 + max_score * 0.5
     deep_th = avg_score * 0.1 + max_score * 0.9
-    print max_score, min_score, avg_score, score_th, deep_th
-
-    kg_query_result = kg.query("""
-                SELECT DISTINCT ?wiki ?type ?score ?name WHERE {
-                   [] <http://schema.org/result> [
-                         a ?type ;
-                         <http://schema.googleapis.com/detailedDescription> [
-                            <http://schema.org/url> ?wiki
-                         ] ;
-                         <http://schema.org/name> ?name
-                      ] ;
-                      <http://schema.googleapis.com/resultScore> ?score
-                }
-            """)
+    log.debug('scores max=%s min=%s avg=%s threshold=%s deep=%s', max_score, min_score, avg_score, score_th, deep_th)
 
     res_dict = {}
     types_score = {}
-    for kgr in kg_query_result:
-        kgr_score = kgr.score.toPython() / kgr_max_score
+    for kgr_score, wiki, name, kgr_types in records:
+        if wiki is None or name is None or not kgr_types:
+            continue
+        kgr_score = kgr_score / kgr_max_score
         if kgr_score >= score_th:
-            wiki_uri = iriToUri(kgr.wiki)
+            wiki_uri = iriToUri(wiki)
             wiki_uri = unquote(wiki_uri).decode('utf8')
-            ty = kg.qname(kgr.type).split(':')[1]
 
             if wiki_uri not in res_dict:
-                res_dict[wiki_uri] = {'types': set(), 'name': kgr.name.toPython(), 'score': kgr_score / max_score}
-            res_dict[wiki_uri]['types'].add(ty)
+                res_dict[wiki_uri] = {'types': set(), 'name': name, 'score': kgr_score / max_score}
+            res_dict[wiki_uri]['types'].update(kgr_types)
+
+    thing_uris = []
+    for wiki, res in res_dict.items():
+        if res['types'] == {'Thing'}:
+            try:
+                thing_uris.append(search_dbpedia_uri(wiki))
+            except UnicodeError:
+                pass
+    if thing_uris:
+        batch_search_types_in_dbpedia(thing_uris)
+
+    similar_names = Query(source_q).matching(
+        res['name'] for res in res_dict.values() if res['score'] > 0.5 / ref_score)
 
     for wiki, res in res_dict.items():
         types = res['types']
         name = res['name']
         score = res['score']
-        try:
-            print u'{} {} {}'.format(wiki, name, score)
-        except:
-            pass
+        log.debug(u'%s %s %s', wiki, name, score)
 
         if len(types) == 1 and 'Thing' in types:
             dbpedia = search_dbpedia_uri(wiki)
@@ -288,61 +781,133 @@ def _kg_search(q, types=None, count=None, trace=None, source_q=None, ref_score=1
             res_dict[wiki]['types'] = enrich_types
 
         for ty in res['types']:
-            if ty != 'Thing' and score > 0.5 / ref_score and similar(source_q, name) > 0.5:
+            if ty != 'Thing' and score > 0.5 / ref_score and name in similar_names:
                 if ty not in types_score:
                     types_score[ty] = set()
                 types_score[ty].add((score, name))
 
+    branches = []
     for ty, pairs in types_score.items():
-        try:
-            for score, name in pairs:
-                if (name, [ty]) not in trace:
-                    more = _kg_search(name, types=[ty], trace=trace, source_q=q, ref_score=score)
-                    for wiki in more:
-                        if wiki not in res_dict:
-                            res_dict[wiki] = more[wiki]
-        except Exception:
-            traceback.print_exc()
+        for score, name in pairs:
+            branches.append((name, [ty], q, score))
+
+    return res_dict, branches
+
+
+@stage('kg_search')
+def _kg_search(q, types=None, count=None, budget=None):
+    """
+    Expands q through KG breadth-first, fanning sibling branches out on kg_pool.
+    When the budget runs out, whatever has been gathered so far is returned.
+    """
+    if budget is None:
+        budget = SearchBudget()
+
+    trace = {(q, tuple(types) if types else None)}
+    if not budget.spend():
+        return {}
 
+    res_dict, branches = _kg_expand(q, types=types, count=count)
+    pending = set()
+    depths = {}
+
+    def fan_out(branches, depth):
+        for name, ty, source_q, score in branches:
+            key = (name, tuple(ty))
+            if key not in trace and budget.spend():
+                trace.add(key)
+                with upstream.priority(upstream.EXPANSION):
+                    future = submit(kg_pool, _kg_expand, name, types=ty, source_q=source_q, ref_score=score)
+                depths[future] = depth
+                pending.add(future)
+
+    fan_out(branches, 1)
+    while pending:
+        done, pending = wait(pending, timeout=budget.remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            budget.exhausted = True
+            for future in pending:
+                future.cancel()
+            break
+
+        for future in done:
+            try:
+                more, branches = future.result()
+            except Exception:
+                log.warning(u'KG expansion failed', exc_info=True)
+                degrade()
+                continue
+
+            for wiki in more:
+                if wiki not in res_dict:
+                    res_dict[wiki] = more[wiki]
+            fan_out(branches, depths[future] + 1)
+
+    expansion_depth.observe(max(depths.values() or [0]))
     return res_dict
 
 
-@kg_cache.memoize(864000)
+@memoize(kg_cache, 864000)
 def kg_search(q, **kwargs):
     return _kg_search(q, **kwargs)
 
 
-def search_entities(q, **kwargs):
+def _completed(pending, cutoff=None):
+    try:
+        with app.app_context():
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    wiki, name, score = pending.pop(future)
+                    try:
+                        types, entity, dbpedia = future.result()
+                    except Exception:
+                        log.warning(u'enrichment of %s failed', wiki, exc_info=True)
+                        degrade()
+                        continue
+                    if cutoff is None or cutoff.admits(score):
+                        yield (types, entity, dbpedia, wiki, name, score)
+
+                if cutoff is not None:
+                    for future, (_, _, score) in pending.items():
+                        if not cutoff.admits(score):
+                            future.cancel()
+                            del pending[future]
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def enrich(candidates, cutoff=None):
+    """
+    Submits the enrichment of (wiki, name, types, score) candidates right away and returns
+    a generator of their seed tuples in completion order. If a cutoff is given, candidates
+    whose score it no longer admits are skipped, and cancelled when still queued.
+    """
+    candidates = [c for c in candidates if cutoff is None or cutoff.admits(c[3])]
+    pending = {}
+    with upstream.priority(upstream.ENRICHMENT):
+        prefetch_enrichment([(wiki, name, types) for wiki, name, types, _ in candidates])
+        for wiki, name, types, score in sorted(candidates, key=lambda c: c[3], reverse=True):
+            future = submit(pool, enrich_wiki_entry, wiki=wiki, name=name, types=types)
+            pending[future] = (wiki, name, score)
+
+    return _completed(pending, cutoff=cutoff)
+
+
+def search_entities(q, cutoff=None, **kwargs):
     kg_results = _kg_search(q, **kwargs)
     # wiki_entities = recognize_entities(q)
 
-    results = []
-    futures = []
+    candidates = [(wiki, res['name'], res['types'], res['score']) for wiki, res in kg_results.items()]
+    for seed_tuple in enrich(candidates, cutoff=cutoff):
+        yield seed_tuple
 
-    for wiki, res in kg_results.items():
-        types = res['types']
-        name = res['name']
-        score = res['score']
-        future = pool.submit(enrich_wiki_entry, wiki=wiki, name=name, types=types)
-        futures.append(future)
-        results.append((future, wiki, name, score))
-
-    # for wiki, res in wiki_entities.items():
-    #     types = res['types']
-    #     name = res['name']
-    #     score = res['score']
-    #     future = pool.submit(enrich_wiki_entry, wiki=wiki, name=name, types=types)
-    #     futures.append(future)
-    #     results.append((future, wiki, name, score))
-
-    with app.app_context():
-        wait(futures)
-        for future, wiki, name, score in results:
-            types, entity, dbpedia = future.result()
-            yield (types, entity, dbpedia, wiki, name, score)
-
-
-@wp_cache.memoize(864000)
+
+@shared
+@single_flight(wp_cache)
+@memoize(wp_cache, 864000, failure={}, canonical={'search': canonical.folded})
+@stage('wikipedia')
 def search_types(search):
     def page_fields(x):
         try:
@@ -353,137 +918,278 @@ def search_types(search):
 
     q_types = {}
     try:
-        try:
-            w_search_pages = [page_fields(x) for x in wikipedia.search(search, results=1)]
-        except wikipedia.exceptions.DisambiguationError as e:
-            w_search_pages = [page_fields(x) for x in e.options if 'disambiguation' not in x]
-            w_search_pages = filter(lambda x: x, w_search_pages)
-
-        for title, url in w_search_pages:
-            w_dbpedia = search_dbpedia_uri(url)
-            dbpedia_types = search_types_in_dbpedia(w_dbpedia)
-            q_types[title] = dbpedia_types
-            print u'{} types: {}'.format(title, q_types[title])
-    except:
-        traceback.print_exc()
-        pass
+        w_search_pages = [page_fields(x) for x in wikipedia.search(search, results=1)]
+    except wikipedia.exceptions.DisambiguationError as e:
+        w_search_pages = [page_fields(x) for x in e.options if 'disambiguation' not in x]
+
+    for title, url in filter(lambda x: x, w_search_pages):
+        w_dbpedia = search_dbpedia_uri(url)
+        dbpedia_types = search_types_in_dbpedia(w_dbpedia)
+        q_types[title] = dbpedia_types
+        log.debug(u'%s types: %s', title, q_types[title])
 
     return q_types
 
 
-@kg_cache.memoize(86400)
-def search_seeds_from_image(img, types=None, count=None, raw=False):
+def _seeds_key(kind, value, types, count, cutoff, *extra):
+    key = (kind, value, sorted(set(types or [])), count, getattr(cutoff, 'key', None)) + extra
+    return 'seeds:{}:{}'.format(kind, hashlib.sha1(repr(key)).hexdigest())
 
+
+def _image_key(img, types=None, count=None, raw=False, budget=None, cutoff=None):
     if isinstance(img, URIRef):
-        image = {
-            "source": {
-                "imageUri": str(img)
-            }
-        }
-    else:
-        image = {
-            "content": base64.b64encode(img.read())
-        }
-
-    print GOOGLE_API_KEY
-    r = requests.post(
-        'https://vision.googleapis.com/v1/images:annotate?key={}'.format(GOOGLE_API_KEY),
-        data=json.dumps({
-            "requests": [
-                {
-                    "image": image,
-                    "features": [
-                        {
-                            "type": "WEB_DETECTION"
-                        }
-                    ]
-                }
-            ]
-        }))
-
-    print r.status_code
-    if r.status_code == 200:
-        data = r.json()
-        if types is None:
-            types = []
-        try:
-            entities = data['responses'][0]['webDetection']['webEntities']
-            mean_score = sum(map(lambda x: x.get('score'), entities)) / len(entities)
+        return _seeds_key('image-url', canonical.url(img), types, count, cutoff, raw)
+    return _seeds_key('image', img.digest, types, count, cutoff, raw)
+
 
-            descriptions = [x.get('description', None) for x in entities if x.get('score') >= mean_score]
-            descriptions = filter(lambda x: x is not None, descriptions)
+def _text_key(q, types=None, count=None, budget=None, cutoff=None):
+    return _seeds_key('text', canonical.text(q), types, count, cutoff)
 
-            if raw:
-                for d in descriptions:
-                    yield d
+
+def _url_key(url, types=None, count=None, budget=None, cutoff=None):
+    return _seeds_key('url', canonical.url(url), types, count, cutoff)
+
+
+def cached_seeds(make_key, timeout=86400):
+    """
+    Caches in kg_cache the list of tuples a seed generator yields, under make_key(*args, **kwargs).
+    Runs that are abandoned, stopped by an exhausted budget or degraded by failed calls are not
+    cached, and empty lists only for EMPTY_TIMEOUT. Tuples a cutoff rejects could never be selected
+    with it, so its key is part of the cache key.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = make_key(*args, **kwargs)
+            seeds = kg_cache.get(key)
+            if seeds is None:
+                seeds = []
+                budget = kwargs.get('budget', None) or SearchBudget()
+                with tracking(budget):
+                    for seed in f(*args, **kwargs):
+                        seeds.append(seed)
+                        yield seed
+
+                if not (budget.exhausted or budget.degraded):
+                    kg_cache.set(key, seeds, timeout=timeout if seeds else EMPTY_TIMEOUT)
             else:
-                desc_types = {}
-                for desc in filter(lambda x: x, descriptions):
-                    for q, d_types in search_types(desc.lower()).items():
-                        if q not in desc_types:
-                            r_types = set.intersection(d_types, types) if types else d_types
-                            desc_types[q] = list(r_types)
-                        else:
-                            r_types = set(desc_types[q]).intersection(d_types) if types else set(desc_types[q]).union(d_types)
-                            desc_types[q] = list(r_types)
-                for d, found_types in desc_types.items():
-                    for seed_tuple in search_seeds(d, types=list(set(types).union(found_types)), count=count):
-                        yield seed_tuple
-        except:
-            pass
+                for seed in seeds:
+                    yield seed
+
+        return wrapper
+
+    return decorator
+
+
+class ImageTooLarge(ValueError):
+    """
+    An image is larger than MAX_IMAGE_SIZE and cannot be downscaled, for Pillow is not installed.
+    """
+
+
+class ImageContent(object):
+    """
+    An uploaded image, identified by the SHA-1 of its content, which is hashed in chunks as it
+    streams in rather than held in memory. Its repr is its identity, so calls taking it are
+    memoized by content.
+    """
+
+    def __init__(self, stream, chunk_size=65536):
+        digest = hashlib.sha1()
+        size = 0
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+        stream.seek(0)
+        self.stream = stream
+        self.digest = digest.hexdigest()
+        self.size = size
+        if size > MAX_IMAGE_SIZE and Image is None:
+            raise ImageTooLarge('image of {} bytes exceeds {}'.format(size, MAX_IMAGE_SIZE))
+
+    def __repr__(self):
+        return 'ImageContent({})'.format(self.digest)
+
+    def read(self):
+        """
+        The content of the image, downscaled to MAX_IMAGE_SIZE if larger.
+        """
+        self.stream.seek(0)
+        if self.size <= MAX_IMAGE_SIZE:
+            return self.stream.read()
+
+        image = Image.open(self.stream)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        scale = (float(MAX_IMAGE_SIZE) / self.size) ** 0.5
+        while True:
+            width, height = image.size
+            image = image.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.ANTIALIAS)
+            out = BytesIO()
+            image.save(out, format='JPEG', quality=85)
+            if out.tell() <= MAX_IMAGE_SIZE:
+                return out.getvalue()
+            scale = 0.75
+
+
+def _vision_request(img):
+    if isinstance(img, URIRef):
+        image = '{{"source": {{"imageUri": {}}}}}'.format(json.dumps(unicode(img)))
+    else:
+        image = '{{"content": "{}"}}'.format(base64.b64encode(img.read()))
+    return '{{"requests": [{{"image": {}, "features": [{{"type": "WEB_DETECTION"}}]}}]}}'.format(image)
+
+
+def _canonical_image(img):
+    return canonical.url(img) if isinstance(img, URIRef) else img
+
+
+@shared
+@single_flight(vs_cache)
+@memoize(vs_cache, 864000, fresh=864000, failure=[], canonical={'img': _canonical_image})
+@stage('vision')
+def web_entities(img):
+    """
+    Web entities Vision detects in an image, given by URL (URIRef) or content (ImageContent).
+    They are never refreshed in the background, as uploads are gone by then.
+    """
+    response = upstream.post('{}?key={}'.format(VISION_API, GOOGLE_API_KEY), data=_vision_request(img))
+    log.debug('vision responded %s', response.status_code)
+    response.raise_for_status()
+    return response.json()['responses'][0].get('webDetection', {}).get('webEntities', [])
+
+
+def _merged_seeds(searches):
+    """
+    Runs the (seed generator function, args, kwargs, times) searches concurrently on names_pool and
+    yields their seed tuples as soon as any of them produces one, each as many times as its search
+    says. If the caller stops early, queued searches are cancelled and running ones stop at their
+    next tuple.
+    """
+    produced = Queue()
+    stop = Event()
+    finished = object()
+
+    def produce(fn, args, kwargs, times):
+        try:
+            for seed_tuple in fn(*args, **kwargs):
+                if stop.is_set():
+                    break
+                produced.put((seed_tuple, times))
+        except Exception:
+            log.warning(u'searching seeds failed', exc_info=True)
+            degrade()
+        finally:
+            produced.put(finished)
 
+    futures = [submit(names_pool, produce, *search) for search in searches]
+    try:
+        running = len(futures)
+        while running:
+            item = produced.get()
+            if item is finished:
+                running -= 1
+                continue
+            seed_tuple, times = item
+            for _ in range(times):
+                yield seed_tuple
+    finally:
+        stop.set()
+        for future in futures:
+            future.cancel()
 
-@kg_cache.memoize(86400)
-def search_seeds_from_text(q, types=None, count=None):
+
+@cached_seeds(_image_key)
+def search_seeds_from_image(img, types=None, count=None, raw=False, budget=None, cutoff=None):
+    try:
+        entities = web_entities(img)
+    except upstream.Throttled:
+        log.warning('detecting web entities was throttled', exc_info=True)
+        degrade()
+        return
     if types is None:
         types = []
+    try:
+        mean_score = sum(map(lambda x: x.get('score'), entities)) / len(entities)
+
+        descriptions = [x.get('description', None) for x in entities if x.get('score') >= mean_score]
+        descriptions = filter(lambda x: x is not None, descriptions)
+
+        if raw:
+            for d in descriptions:
+                yield d
+        else:
+            desc_types = {}
+            found = [submit(names_pool, search_types, desc.lower()) for desc in filter(lambda x: x, descriptions)]
+            for future in found:
+                for q, d_types in future.result().items():
+                    if q not in desc_types:
+                        r_types = set.intersection(d_types, types) if types else d_types
+                        desc_types[q] = list(r_types)
+                    else:
+                        r_types = set(desc_types[q]).intersection(d_types) if types else set(desc_types[q]).union(d_types)
+                        desc_types[q] = list(r_types)
+
+            searches = [(search_seeds, (d,), dict(types=list(set(types).union(found_types)), count=count,
+                                                  budget=budget, cutoff=cutoff), 1)
+                        for d, found_types in desc_types.items()]
+            for seed_tuple in _merged_seeds(searches):
+                yield seed_tuple
+    except Exception:
+        # Without entities there is nothing to search, which is no failure
+        if entities:
+            degrade()
 
-    wiki_entities = recognize_entities(q)
-    futures = []
-    results = []
-
-    for wiki, res in wiki_entities.items():
-        name = res['name']
-        score = res['score']
-        future = pool.submit(enrich_wiki_entry, wiki=wiki, name=name, types=['Thing'])
-        futures.append(future)
-        results.append((future, wiki, name, score))
 
-    all_q = {q}.union(map(lambda x: x['name'], wiki_entities.values()))
+def name_seeds(q, types=None, count=None, budget=None, cutoff=None):
+    """
+    Seed tuples of a lowercased name and of the Wikipedia pages it leads to, as far as they could be searched.
+    """
+    try:
+        for seed_tuple in search_seeds(q, types=types, count=count, budget=budget, cutoff=cutoff):
+            yield seed_tuple
 
-    for q in all_q:
-        try:
-            for seed_tuple in search_seeds(q.lower(), types=types, count=count):
+        for title, found_types in search_types(q).items():
+            for seed_tuple in search_seeds(title, types=list(set(types).union(found_types)), count=count,
+                                           budget=budget, cutoff=cutoff):
                 yield seed_tuple
+    except Exception:
+        log.warning(u'searching seeds of "%s" failed', q, exc_info=True)
+        degrade()
 
-            for q, found_types in search_types(q.lower()).items():
-                for seed_tuple in search_seeds(q, types=list(set(types).union(found_types)), count=count):
-                    yield seed_tuple
-        except:
-            pass
 
-    with app.app_context():
-        wait(futures)
-        for future, wiki, name, score in results:
-            types, entity, dbpedia = future.result()
-            yield (types, entity, dbpedia, wiki, name, score)
+@cached_seeds(_text_key)
+def search_seeds_from_text(q, types=None, count=None, budget=None, cutoff=None):
+    if types is None:
+        types = []
 
+    wiki_entities = recognize_entities(q)
+    enriched = enrich([(wiki, res['name'], ['Thing'], res['score']) for wiki, res in wiki_entities.items()],
+                      cutoff=cutoff)
+
+    # No query, or annotations without a name, leave no name to search
+    all_q = filter(None, {q}.union(map(lambda x: x['name'], wiki_entities.values())))
+
+    # Names that only differ in case are searched once, but their seeds still count once per name
+    spellings = Counter(q.lower() for q in all_q)
+    searches = [(name_seeds, (q,), dict(types=types, count=count, budget=budget, cutoff=cutoff), n)
+                for q, n in spellings.items()]
+    for seed_tuple in _merged_seeds(searches):
+        yield seed_tuple
+
+    for seed_tuple in enriched:
+        yield seed_tuple
 
-@kg_cache.memoize(86400)
-def search_seeds_from_url(url, types=None, count=None):
+
+@cached_seeds(_url_key)
+def search_seeds_from_url(url, types=None, count=None, budget=None, cutoff=None):
     if types is None:
         types = []
 
     wiki_entities = recognize_entities(url=url)
-    futures = []
-    results = []
-
-    for wiki, res in wiki_entities.items():
-        name = res['name']
-        score = res['score']
-        future = pool.submit(enrich_wiki_entry, wiki=wiki, name=name, types=['Thing'])
-        futures.append(future)
-        results.append((future, wiki, name, score))
+    enriched = enrich([(wiki, res['name'], ['Thing'], res['score']) for wiki, res in wiki_entities.items()],
+                      cutoff=cutoff)
 
     # all_q = set(map(lambda x: x['name'], wiki_entities.values()))
     #
@@ -498,11 +1204,8 @@ def search_seeds_from_url(url, types=None, count=None):
     #     except:
     #         pass
 
-    with app.app_context():
-        wait(futures)
-        for future, wiki, name, score in results:
-            types, entity, dbpedia = future.result()
-            yield (types, entity, dbpedia, wiki, name, score)
+    for seed_tuple in enriched:
+        yield seed_tuple
 
 
 def search_seeds(search, types=None, **kwargs):
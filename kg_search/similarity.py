@@ -0,0 +1,79 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+from collections import Counter
+from difflib import SequenceMatcher
+
+__author__ = 'Fernando Serena'
+
+THRESHOLD = 0.5
+MEMO_SIZE = 100000
+
+_memo = {}
+
+
+def similar(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+
+class Query(object):
+    """
+    A query prepared once to tell which candidate names are similar(query, name) > threshold.
+    Names are rejected on upper bounds of the ratio (lengths, then shared characters) before
+    falling back to SequenceMatcher, so decisions are exactly those of similar().
+    Decisions are memoized per (query, name).
+    """
+
+    def __init__(self, text, threshold=THRESHOLD):
+        self.text = text
+        self.threshold = threshold
+        self.__chars = Counter(text).items()
+
+    def __bound(self, name):
+        length = len(self.text) + len(name)
+        if not length:
+            return 1.0
+        if 2.0 * min(len(self.text), len(name)) / length <= self.threshold:
+            return 0.0
+        common = sum(min(n, name.count(c)) for c, n in self.__chars)
+        return 2.0 * common / length
+
+    def matches(self, name):
+        key = (self.text, name, self.threshold)
+        try:
+            return _memo[key]
+        except KeyError:
+            pass
+
+        if name == self.text:
+            match = 1.0 > self.threshold
+        elif self.__bound(name) <= self.threshold:
+            match = False
+        else:
+            match = similar(self.text, name) > self.threshold
+
+        if len(_memo) >= MEMO_SIZE:
+            _memo.clear()
+        _memo[key] = match
+        return match
+
+    def matching(self, names):
+        return set(name for name in set(names) if self.matches(name))
@@ -0,0 +1,169 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+from itertools import islice
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from kg_search.caching import backends, rebased
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger(__name__)
+
+FORMAT = 'kg-search-cache'
+VERSION = 1
+BATCH_SIZE = int(os.environ.get('CACHE_SNAPSHOT_BATCH', 1000))
+
+with open(os.path.join(os.path.dirname(__file__), 'metadata.json')) as stream:
+    RELEASE = json.load(stream)['version']
+
+
+def _batches(entries, size=BATCH_SIZE):
+    entries = iter(entries)
+    while True:
+        batch = list(islice(entries, size))
+        if not batch:
+            return
+        yield batch
+
+
+def export_snapshot(path, names=None, max_age=None):
+    """
+    Writes the entries still alive of the named caches (all by default), stored at most max_age
+    seconds ago if given, to a gzip-compressed snapshot: a versioned header followed by batches of
+    (cache, hashed keys, entries). Returns the number of entries by cache.
+    """
+    created = time.time()
+    exported = {}
+    tmp = path + '.tmp'
+    with gzip.open(tmp, 'wb', 6) as f:
+        pickle.dump({'format': FORMAT, 'version': VERSION, 'release': RELEASE, 'created': created}, f,
+                    pickle.HIGHEST_PROTOCOL)
+        for name, backend in backends.items():
+            if names and name not in names:
+                continue
+            if not hasattr(backend, 'dump'):
+                log.warning('%s cannot be exported', name)
+                continue
+            hashed = getattr(backend, 'hashed_keys', False)
+            entries = backend.dump()
+            if max_age is not None:
+                entries = (entry for entry in entries if created - entry[3] <= max_age)
+            exported[name] = 0
+            for batch in _batches(entries):
+                # Pickled twice, as unpickling straight from the file would read it a few bytes at a time
+                pickle.dump(pickle.dumps((name, hashed, batch), pickle.HIGHEST_PROTOCOL), f,
+                            pickle.HIGHEST_PROTOCOL)
+                exported[name] += len(batch)
+    os.rename(tmp, path)
+    return exported
+
+
+def _imported(entries, now, max_age=None, shift=0):
+    for key, data, expires, stored in entries:
+        if max_age is not None and now - shift - stored > max_age:
+            continue
+        if expires:
+            expires += shift
+            if expires <= now:
+                continue
+        if shift:
+            data = rebased(data, shift)
+        yield key, data, expires, stored + shift
+
+
+def import_snapshot(path, names=None, max_age=None, rebase=False):
+    """
+    Loads the entries of a snapshot into the named caches (all by default) in bulk, one batch at a
+    time, keeping the entries they already hold. If rebase, entries keep the time to live they had
+    when exported instead of expiring as if they had stayed in a cache since. Entries older than
+    max_age seconds are skipped, their age counted up to the export if rebase. Returns the number
+    of entries loaded by cache. Snapshots are pickles, so only import trusted ones.
+    """
+    now = time.time()
+    imported = {}
+    with gzip.open(path, 'rb') as f:
+        try:
+            header = pickle.load(f)
+        except Exception:
+            header = None
+        if not isinstance(header, dict) or header.get('format') != FORMAT:
+            raise ValueError('{} is not a cache snapshot'.format(path))
+        if header['version'] > VERSION:
+            raise ValueError('{} has version {}, only up to {} is supported'.format(path, header['version'],
+                                                                                    VERSION))
+        shift = now - header['created'] if rebase else 0
+        refused = set()
+        while True:
+            try:
+                name, hashed, batch = pickle.loads(pickle.load(f))
+            except EOFError:
+                break
+            if (names and name not in names) or name in refused:
+                continue
+            backend = backends.get(name)
+            if not hasattr(backend, 'load'):
+                log.warning('%s cannot be imported', name)
+                refused.add(name)
+                continue
+            try:
+                loaded = backend.load(_imported(batch, now, max_age, shift), hashed=hashed)
+            except ValueError as e:
+                log.warning('cannot import %s: %s', name, e)
+                refused.add(name)
+                continue
+            imported[name] = imported.get(name, 0) + loaded
+    return imported
+
+
+def main(argv=None):
+    """
+    kg-search cache export|import [--caches NAME,...] [--max-age SECONDS] [--rebase] SNAPSHOT
+    """
+    parser = argparse.ArgumentParser(prog='kg-search cache', description='Exports or imports cache snapshots.')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('snapshot', help='path of the snapshot file')
+    parser.add_argument('--caches', type=lambda value: set(filter(None, value.split(','))),
+                        help='comma-separated caches, all by default: ' + ','.join(backends))
+    parser.add_argument('--max-age', type=float, help='skip entries stored longer ago, in seconds')
+    parser.add_argument('--rebase', action='store_true',
+                        help='on import, count the time to live of entries from now instead of from the export')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    if args.command == 'export':
+        counts = export_snapshot(args.snapshot, names=args.caches, max_age=args.max_age)
+    else:
+        counts = import_snapshot(args.snapshot, names=args.caches, max_age=args.max_age, rebase=args.rebase)
+    for name, n in sorted(counts.items()):
+        log.info('%s: %s %d entries', name, '{}ed'.format(args.command), n)
+    log.info('%sed %d entries in %.2fs', args.command, sum(counts.values()), time.time() - start)
+    return 0
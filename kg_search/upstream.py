@@ -0,0 +1,276 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import heapq
+import json
+import os
+import random
+import time
+import urlparse
+from contextlib import contextmanager
+from email.utils import parsedate_tz, mktime_tz
+from itertools import count
+from multiprocessing import cpu_count
+from threading import Condition, local
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from kg_search import GREEN, WORKERS, metrics
+
+__author__ = 'Fernando Serena'
+
+with open(os.path.join(os.path.dirname(__file__), 'metadata.json')) as stream:
+    USER_AGENT = 'kg-search/{} ({})'.format(json.load(stream)['version'], 'https://github.com/fserena/kg-search')
+
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 500 if GREEN else max(cpu_count() * 5 // WORKERS, 5)))
+POOL_HOSTS = int(os.environ.get('UPSTREAM_POOL_HOSTS', 16))
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 30))
+QUEUE_TIMEOUT = float(os.environ.get('UPSTREAM_QUEUE_TIMEOUT', 30))
+BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 1))
+RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+RETRY_STATUSES = {429, 503}
+
+# Admission priorities, lowest first. Background work, like refreshing stale cache entries, goes last
+SEED, EXPANSION, ENRICHMENT, BACKGROUND = 0, 1, 2, 3
+
+
+def _settings(name):
+    """
+    Per-provider numbers from an environment variable like 'kg=10,wikidata=5'.
+    """
+    settings = {}
+    for pair in filter(None, os.environ.get(name, '').split(',')):
+        provider, value = pair.split('=')
+        settings[provider.strip()] = float(value)
+    return settings
+
+
+RATES = _settings('UPSTREAM_RATES')
+CONCURRENCY = _settings('UPSTREAM_CONCURRENCY')
+
+session = requests.Session()
+session.headers.update({'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'})
+_adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+
+_context = local()
+
+
+@contextmanager
+def priority(level):
+    """
+    Upstream requests made by this thread within the context are admitted with the given priority.
+    """
+    previous = current_priority()
+    _context.priority = level
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def current_priority():
+    return getattr(_context, 'priority', SEED)
+
+
+class Throttled(requests.exceptions.RequestException):
+    """
+    A request waited longer than the queue timeout to be admitted by its provider.
+    """
+
+
+class Limiter(object):
+    """
+    Admission control of one upstream provider. A token bucket bounds the request rate and an
+    AIMD limit bounds the requests in flight: it halves when the provider throttles or fails
+    (at most once per second) and grows back by one per round of successes. Waiting requests
+    are admitted by priority, then in arrival order.
+    """
+
+    def __init__(self, name, rate=None, burst=None, concurrency=8):
+        self.name = name
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst or max(rate or 1, 1))
+        self.max_limit = float(concurrency)
+        self.limit = float(concurrency)
+        self.tokens = self.burst
+        self.in_flight = 0
+        self.__refilled = time.time()
+        self.__decreased = 0
+        self.__queue = []
+        self.__seq = count()
+        self.__cond = Condition()
+
+    def __delay(self, now):
+        """
+        Seconds until a request can be admitted, or None if it has to wait for a release.
+        """
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.__refilled) * self.rate)
+            self.__refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0
+
+    def acquire(self, priority=SEED, timeout=QUEUE_TIMEOUT):
+        entry = (priority, next(self.__seq))
+        start = time.time()
+        with self.__cond:
+            heapq.heappush(self.__queue, entry)
+            try:
+                while True:
+                    now = time.time()
+                    wait = None
+                    if self.__queue[0] == entry:
+                        wait = self.__delay(now)
+                        if wait == 0:
+                            heapq.heappop(self.__queue)
+                            if self.rate is not None:
+                                self.tokens -= 1
+                            self.in_flight += 1
+                            self.__cond.notify_all()
+                            break
+                    if timeout is not None:
+                        remaining = start + timeout - now
+                        if remaining <= 0:
+                            metrics.upstream_throttled.inc(provider=self.name)
+                            raise Throttled('{} did not admit the request within {}s'.format(self.name, timeout))
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self.__cond.wait(wait)
+            except BaseException:
+                if entry in self.__queue:
+                    self.__queue.remove(entry)
+                    heapq.heapify(self.__queue)
+                    self.__cond.notify_all()
+                raise
+        metrics.upstream_queue_seconds.observe(time.time() - start, provider=self.name)
+
+    def release(self, status):
+        """
+        Frees the slot of an admitted request given its response status, None if it got no response.
+        """
+        with self.__cond:
+            self.in_flight -= 1
+            now = time.time()
+            if status is None or status == 429 or status >= 500:
+                if now - self.__decreased >= 1:
+                    self.limit = max(self.limit / 2, 1.0)
+                    self.__decreased = now
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.__cond.notify_all()
+
+
+_limiters = []
+
+
+def provider(name, url, rate=None, concurrency=8, burst=None):
+    """
+    Puts the requests to url and below under the admission control of a provider. Its rate
+    (requests per second, 0 for unbounded) and concurrency can be overridden with the
+    UPSTREAM_RATES and UPSTREAM_CONCURRENCY environment variables. They are what the provider
+    allows the whole service, so each of the WORKERS processes gets its share.
+    """
+    rate = RATES.get(name, rate)
+    admission = Limiter(name, rate=float(rate) / WORKERS if rate else rate,
+                        burst=float(burst) / WORKERS if burst else burst,
+                        concurrency=max(int(CONCURRENCY.get(name, concurrency)) // WORKERS, 1))
+    _limiters.append((url.split('?')[0], admission))
+    _limiters.sort(key=lambda item: len(item[0]), reverse=True)
+    return admission
+
+
+def limiter(url):
+    """
+    The limiter of the provider that url belongs to, if any.
+    """
+    for base, admission in _limiters:
+        if url.startswith(base):
+            return admission
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = parsedate_tz(value)
+        return max(mktime_tz(date) - time.time(), 0) if date else None
+
+
+def request(method, url, **kwargs):
+    """
+    Sends a request through the shared keep-alive session, with the default timeouts unless given.
+    Requests to a registered provider wait for its admission first, and are retried when it
+    answers 429 or 503 after its Retry-After or an exponential backoff.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    host = urlparse.urlsplit(url).hostname
+    admission = limiter(url)
+    attempt = 0
+    while True:
+        if admission is not None:
+            admission.acquire(current_priority())
+        response = None
+        status = 'error'
+        start = time.time()
+        try:
+            response = session.request(method, url, **kwargs)
+            status = response.status_code
+        finally:
+            metrics.upstream_seconds.observe(time.time() - start, host=host)
+            metrics.upstream_requests.inc(host=host, status=status)
+            if admission is not None:
+                admission.release(response.status_code if response is not None else None)
+
+        if admission is None or status not in RETRY_STATUSES or attempt >= RETRIES:
+            return response
+        delay = _retry_after(response)
+        if delay is None:
+            delay = BACKOFF * random.uniform(0.5, 1.5) * 2 ** attempt
+        if delay > QUEUE_TIMEOUT:
+            return response
+        attempt += 1
+        metrics.upstream_retries.inc(provider=admission.name)
+        response.close()
+        time.sleep(delay)
+
+
+def get(url, params=None, **kwargs):
+    return request('GET', url, params=params, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+    return request('POST', url, data=data, **kwargs)
+
+
+def sparql_select(endpoint, query):
+    response = get(endpoint, params={'query': query}, headers={'Accept': 'application/sparql-results+json'})
+    response.raise_for_status()
+    return response.json()["results"]["bindings"]
@@ -0,0 +1,215 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Ontology Engineering Group
+        http://www.oeg-upm.net/
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2016 Ontology Engineering Group.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import bz2
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import urllib
+import urlparse
+from threading import local
+
+__author__ = 'Fernando Serena'
+
+SCHEMA_PREFIXES = ('http://schema.org/', 'https://schema.org/')
+NON_WIKIPEDIA_SITES = {'commonswiki', 'specieswiki', 'metawiki', 'mediawikiwiki', 'wikidatawiki', 'sourceswiki',
+                       'outreachwiki', 'wikimaniawiki', 'incubatorwiki', 'foundationwiki', 'wikifunctionswiki'}
+
+_WIKIPEDIA_SITE = re.compile(r'^([a-z_]+)wiki$')
+_BATCH = 10000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sitelink (key TEXT PRIMARY KEY, item INTEGER);
+CREATE TABLE IF NOT EXISTS instance (item INTEGER, class INTEGER);
+CREATE TABLE IF NOT EXISTS subclass (class INTEGER, parent INTEGER);
+CREATE TABLE IF NOT EXISTS equivalent (class INTEGER, type TEXT);
+CREATE TABLE IF NOT EXISTS class_type (class INTEGER, type TEXT);
+'''
+
+
+def sitelink_key(wiki):
+    """
+    Maps a Wikipedia article URL to its dump sitelink key, e.g. u'enwiki:Real Madrid C.F.'
+    """
+    if isinstance(wiki, unicode):
+        wiki = wiki.encode('utf-8')
+    parts = urlparse.urlsplit(wiki)
+    host = parts.netloc.lower().split(':')[0].replace('.m.wikipedia.org', '.wikipedia.org')
+    if not host.endswith('.wikipedia.org') or not parts.path.startswith('/wiki/'):
+        return None
+    site = host[:-len('.wikipedia.org')].replace('-', '_') + 'wiki'
+    title = urllib.unquote(parts.path[len('/wiki/'):]).decode('utf-8', 'replace').replace(u'_', u' ')
+    if not title:
+        return None
+    return u'{}:{}{}'.format(site, title[0].upper(), title[1:])
+
+
+def _truthy(statements):
+    """
+    Values of the best-ranked statements, like wdt: in the query service.
+    """
+    statements = [st for st in statements if st.get('rank') != 'deprecated']
+    preferred = [st for st in statements if st.get('rank') == 'preferred']
+    for st in preferred or statements:
+        snak = st.get('mainsnak', {})
+        if snak.get('snaktype') == 'value':
+            yield snak['datavalue']['value']
+
+
+def _item_ids(statements):
+    for value in _truthy(statements):
+        if isinstance(value, dict) and value.get('entity-type') == 'item':
+            yield value['numeric-id']
+
+
+def _open_dump(path):
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path)
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path)
+
+
+def _entities(dump):
+    for line in dump:
+        line = line.strip().rstrip(',')
+        if line and line not in ('[', ']'):
+            yield json.loads(line)
+
+
+def build(dump_path, index_path, log=sys.stderr):
+    """
+    Streams a Wikidata JSON dump into a sitelink -> item, item -> direct class and class ->
+    schema.org types (closed over P279 and P1709) SQLite index.
+    """
+    db = sqlite3.connect(index_path, isolation_level=None)
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    db.executescript(_SCHEMA)
+
+    rows = {'sitelink': [], 'instance': [], 'subclass': [], 'equivalent': []}
+    inserts = {'sitelink': 'INSERT OR IGNORE INTO sitelink VALUES (?, ?)',
+               'instance': 'INSERT INTO instance VALUES (?, ?)',
+               'subclass': 'INSERT INTO subclass VALUES (?, ?)',
+               'equivalent': 'INSERT INTO equivalent VALUES (?, ?)'}
+
+    def flush():
+        db.execute('BEGIN')
+        for table, table_rows in rows.items():
+            db.executemany(inserts[table], table_rows)
+            del table_rows[:]
+        db.execute('COMMIT')
+
+    start = time.time()
+    n = 0
+    with _open_dump(dump_path) as dump:
+        for entity in _entities(dump):
+            if entity.get('type') != 'item':
+                continue
+            item = int(entity['id'][1:])
+            for site, sitelink in entity.get('sitelinks', {}).items():
+                if _WIKIPEDIA_SITE.match(site) and site not in NON_WIKIPEDIA_SITES:
+                    rows['sitelink'].append((u'{}:{}'.format(site, sitelink['title']), item))
+
+            claims = entity.get('claims', {})
+            rows['instance'].extend((item, cls) for cls in _item_ids(claims.get('P31', [])))
+            rows['subclass'].extend((item, parent) for parent in _item_ids(claims.get('P279', [])))
+            for url in _truthy(claims.get('P1709', [])):
+                if isinstance(url, basestring) and url.startswith(SCHEMA_PREFIXES):
+                    rows['equivalent'].append((item, url.split('schema.org/', 1)[1]))
+
+            n += 1
+            if n % _BATCH == 0:
+                flush()
+                if n % (_BATCH * 100) == 0:
+                    print >> log, '{} items indexed in {:.0f}s'.format(n, time.time() - start)
+    flush()
+
+    print >> log, 'computing the schema.org type closure...'
+    db.executescript('''
+        CREATE INDEX IF NOT EXISTS subclass_parent ON subclass (parent);
+        DELETE FROM class_type;
+        INSERT INTO class_type
+            WITH RECURSIVE closure(class, type) AS (
+                SELECT class, type FROM equivalent
+                UNION
+                SELECT subclass.class, closure.type FROM subclass JOIN closure ON subclass.parent = closure.class
+            )
+            SELECT class, type FROM closure;
+        CREATE INDEX IF NOT EXISTS instance_item ON instance (item);
+        CREATE INDEX IF NOT EXISTS class_type_class ON class_type (class);
+        DROP TABLE subclass;
+        DROP TABLE equivalent;
+        VACUUM;
+    ''')
+    db.close()
+    print >> log, '{} items indexed in {:.0f}s'.format(n, time.time() - start)
+
+
+class WikidataIndex(object):
+    """
+    Read side of an index built with build(), memory-mapped and shared by all threads.
+    Lookups return None when the index does not know the answer.
+    """
+
+    def __init__(self, path, mmap_size=1 << 34):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.__local = local()
+        self._db()
+
+    def _db(self):
+        if getattr(self.__local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('PRAGMA query_only=1')
+            db.execute('PRAGMA mmap_size={:d}'.format(self.mmap_size))
+            self.__local.db = db
+            self.__local.pid = os.getpid()
+        return self.__local.db
+
+    def entity(self, wiki):
+        key = sitelink_key(wiki)
+        if key is None:
+            return None
+        row = self._db().execute('SELECT item FROM sitelink WHERE key = ?', (key,)).fetchone()
+        return 'Q{}'.format(row[0]) if row else None
+
+    def types(self, entity):
+        if not entity or not entity.startswith('Q'):
+            return None
+        item = int(entity[1:])
+        db = self._db()
+        if db.execute('SELECT 1 FROM instance WHERE item = ? LIMIT 1', (item,)).fetchone() is None:
+            return None
+        rows = db.execute('SELECT DISTINCT class_type.type FROM instance JOIN class_type '
+                          'ON class_type.class = instance.class WHERE instance.item = ?', (item,))
+        return set(row[0] for row in rows)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print >> sys.stderr, 'usage: python -m kg_search.wdindex <wikidata-dump.json[.bz2|.gz]> <index.db>'
+        sys.exit(1)
+    build(sys.argv[1], sys.argv[2])
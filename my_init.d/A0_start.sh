@@ -3,4 +3,8 @@ echo "Starting kg-search..."
 
 /root/.env/bin/pip install --upgrade pip
 /root/.env/bin/pip install --upgrade git+https://github.com/fserena/kg-search.git
+# Warm start from a snapshot made with `kg-search cache export`
+if [ -n "$CACHE_SNAPSHOT" ] && [ -f "$CACHE_SNAPSHOT" ]; then
+    /root/.env/bin/kg-search cache import --rebase ${CACHE_SNAPSHOT_MAX_AGE:+--max-age $CACHE_SNAPSHOT_MAX_AGE} "$CACHE_SNAPSHOT"
+fi
 /root/.env/bin/kg-search &
@@ -41,6 +41,7 @@ setup(
     packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
     install_requires=['Flask', 'Flask-Cache', 'gunicorn', 'futures', 'requests', 'urllib3', 'rdflib==4.2.0',
                       'python-dateutil', 'pyld', 'rdflib-jsonld', 'shortuuid', 'wikipedia==1.4.0'],
+    extras_require={'gevent': ['gevent'], 'images': ['Pillow']},
     classifiers=[],
     package_dir={'kg_search': 'kg_search'},
     package_data={'kg_search': ['metadata.json']},